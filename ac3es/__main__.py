@@ -20,6 +20,7 @@ from ac3es.cli import BaseCliCommand
 from ac3es.exceptions import CliException
 import sys
 import argparse
+import multiprocessing
 
 # we need to import the classes even if we don't use them directly
 from ac3es.bin import CliBin
@@ -29,6 +30,8 @@ from ac3es.tim import CliTim
 from ac3es.ulz import CliUlz
 
 if __name__ == '__main__':
+    # the ulz batch modes use a pool of processes, needed by the frozen executable
+    multiprocessing.freeze_support()
 
     epilog = """Example:
 
@@ -38,9 +41,18 @@ if __name__ == '__main__':
     or define another destination
       {0} ulz --compress jap_0002.tim --ulz-type=2 --level=1 --output-file=mycompress.ulz
 
+    Compress many files using 4 processes
+      {0} ulz --compress translated/*.tim --ulz-type=2 --level=1 --jobs=4
+
+    Decompress every ulz file found in an unpacked BPB
+      {0} ulz --decompress-tree BPB --jobs=4
+
     Get what parameters use from the original file
       {0} info BPB/0386/0001/0000.ulz
 
+    Put back into ACE.BPB only the entries changed in the unpacked tree
+      {0} bpb --repack=BPB --index
+
     Work on bin containers
       {0} bin --split=BPB/0114/0007.bin --out-directory=splitted/0007 --out-list=splitted/0007.txt
       {0} bin --merge-list=splitted/0007.txt --out-bin=mod_0007.bin
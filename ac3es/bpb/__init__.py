@@ -14,6 +14,8 @@
 #  You should have received a copy of the GNU General Public License
 #  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
 
-from ac3es.bpb.pack import pack_files
+from ac3es.bpb.pack import pack_files, repack_files
 from ac3es.bpb.unpack import unpack_files
+from ac3es.bpb.archive import BpbArchive
+from ac3es.bpb.index import BpbIndex, load_index, default_index_path
 from ac3es.bpb.cli import CliBpb
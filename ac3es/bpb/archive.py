@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#  This file is part of AC3ES Tools.
+#
+#  AC3ES Tools is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  AC3ES Tools is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+import dataclasses
+import io
+import mmap
+import pathlib
+import typing
+
+from ac3es.bpb.index import EXTENSIONS
+from ac3es.bpb.unpack import read_bph, probe_container, leaf_extension
+
+
+@dataclasses.dataclass
+class BpbNode:
+    path: str
+    offset: int
+    size: int
+    is_dir: bool
+    extension: str = ''
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    File object reading a memoryview, for the code that wants a stream
+    """
+
+    def __init__(self, view):
+        super().__init__()
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self.view[self.position:self.position + len(buffer)]
+        memoryview(buffer).cast('B')[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+
+class BpbArchive:
+    """
+    Reads ACE.BPB without unpacking it, the paths are the same of the
+    unpacked tree, like 0386/0001/0000 or 0386/0001/0000.tim, the
+    extension is optional.
+
+    The BPH is read once, the nested containers are probed only when
+    a path goes through them, with the same rules of unpack_all. The
+    data comes from a read-only mapping of the BPB, read returns a
+    memoryview of it, so the views must be released before closing
+    the archive.
+
+    With a BpbIndex nothing is probed, the layout comes from the index.
+    """
+
+    def __init__(self, bpb: pathlib.Path, bph: pathlib.Path, index=None):
+        self.bpb_path = pathlib.Path(bpb)
+        self.bph_path = pathlib.Path(bph)
+        self.bpb_file = self.bpb_path.open('rb')
+        self.bpb_map = mmap.mmap(self.bpb_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.bpb_view = memoryview(self.bpb_map)
+
+        # children of every container already probed, the key is the
+        # tuple of indexes from the top, the root is ()
+        self.children = {(): read_bph(self.bph_path)}
+        self.extensions = {}
+        if index is not None:
+            self.children = index.children()
+            self.extensions = {node.key: EXTENSIONS[node.kind] for node in index.files()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.bpb_view.release()
+        self.bpb_map.close()
+        self.bpb_file.close()
+
+    @staticmethod
+    def split_path(path) -> typing.Tuple[int, ...]:
+        parts = pathlib.PurePosixPath(str(path)).parts
+        try:
+            return tuple(int(part.split('.')[0]) for part in parts if part not in ('/', '.'))
+        except ValueError:
+            raise FileNotFoundError(path)
+
+    def get_children(self, key):
+        """
+        The chunks of a container, None when the key is a file
+        """
+        if key not in self.children:
+            offset, size = self.get_chunk(key)
+            self.children[key] = probe_container(self.bpb_view, offset, size)
+        return self.children[key]
+
+    def get_chunk(self, key):
+        """
+        Offset and size in the BPB of the node
+        """
+        chunks = self.get_children(key[:-1])
+        if chunks is None or not 0 <= key[-1] < len(chunks):
+            raise FileNotFoundError('/'.join(f'{idx:04d}' for idx in key))
+        return chunks[key[-1]]
+
+    def get_extension(self, key) -> str:
+        if key not in self.extensions:
+            offset, size = self.get_chunk(key)
+            self.extensions[key] = leaf_extension(self.bpb_view, offset, size)
+        return self.extensions[key]
+
+    def node_name(self, key) -> str:
+        name = f'{key[-1]:04d}'
+        if self.get_children(key) is None:
+            name += self.get_extension(key)
+        return name
+
+    def stat(self, path) -> BpbNode:
+        key = self.split_path(path)
+        if not key:
+            return BpbNode('', 0, len(self.bpb_view), True)
+
+        offset, size = self.get_chunk(key)
+        is_dir = self.get_children(key) is not None
+        name = '/'.join(f'{idx:04d}' for idx in key)
+        return BpbNode(
+            name,
+            offset,
+            size,
+            is_dir,
+            '' if is_dir else self.get_extension(key)
+        )
+
+    def listdir(self, path='') -> typing.List[str]:
+        key = self.split_path(path)
+        chunks = self.get_children(key) if key else self.children[()]
+        if chunks is None:
+            raise NotADirectoryError(path)
+        return [self.node_name(key + (idx,)) for idx in range(len(chunks))]
+
+    def read(self, path) -> memoryview:
+        node = self.stat(path)
+        if node.is_dir:
+            raise IsADirectoryError(path)
+        return self.bpb_view[node.offset:node.offset + node.size]
+
+    def open(self, path) -> io.BufferedReader:
+        return io.BufferedReader(ChunkReader(self.read(path)))
+
+    def walk(self, path=''):
+        """
+        Every file under path, as BpbNode, in the same order of the
+        unpacked tree
+        """
+        for name in self.listdir(path):
+            child = '/'.join(x for x in (str(path).strip('/'), name) if x)
+            node = self.stat(child)
+            if node.is_dir:
+                yield from self.walk(child)
+            else:
+                yield node
@@ -46,6 +46,13 @@ class CliBpb(BaseCliCommand):
             help='Pack ACE.BPB and create ACE.BPH from a given directory'
         )
 
+        parser_bpb_main.add_argument(
+            '--repack',
+            '-r',
+            metavar=('DIRECTORY'),
+            help='Write into the existing ACE.BPB/BPH only the entries of the directory that changed'
+        )
+
         parser_bpb.add_argument(
             '--bpb',
             metavar=('ACE.BPB'),
@@ -58,6 +65,21 @@ class CliBpb(BaseCliCommand):
             help='Path for ACE.BPH'
         )
 
+        parser_bpb.add_argument(
+            '--jobs',
+            '-j',
+            type=int,
+            default=1,
+            help='Number of entries to unpack at the same time'
+        )
+
+        parser_bpb.add_argument(
+            '--index',
+            '-i',
+            action='store_true',
+            help='Read the layout of the BPB from ACE.BPB.idx, the index is rebuilt when missing or outdated'
+        )
+
         parser_bpb.set_defaults(bpb='ACE.BPB', bph='ACE.BPH')
 
         return subparsers
@@ -65,7 +87,28 @@ class CliBpb(BaseCliCommand):
     def run_cmd(self, args):
         self.args = args
 
+        index = None
+        if args.index and (args.unpack is not None or args.repack is not None):
+            index = bpb.load_index(pathlib.Path(args.bpb), pathlib.Path(args.bph))
+
         if args.pack is not None:
             bpb.pack_files(pathlib.Path(args.pack), pathlib.Path(args.bpb), pathlib.Path(args.bph))
+        elif args.repack is not None:
+            written = bpb.repack_files(
+                pathlib.Path(args.repack),
+                pathlib.Path(args.bpb),
+                pathlib.Path(args.bph),
+                index
+            )
+            for idx, sector, action in written:
+                print('{:5} {:04d} sector {}'.format(action.upper(), idx, sector))
+            if index is not None and written:
+                index.save(bpb.default_index_path(pathlib.Path(args.bpb)))
         elif args.unpack is not None:
-            bpb.unpack_files(pathlib.Path(args.unpack), pathlib.Path(args.bpb), pathlib.Path(args.bph))
+            bpb.unpack_files(
+                pathlib.Path(args.unpack),
+                pathlib.Path(args.bpb),
+                pathlib.Path(args.bph),
+                args.jobs,
+                index
+            )
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#  This file is part of AC3ES Tools.
+#
+#  AC3ES Tools is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  AC3ES Tools is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+import dataclasses
+import hashlib
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import tempfile
+import typing
+import zlib
+
+from ac3es.bpb.unpack import read_bph, probe_container, leaf_extension
+
+KIND_CONTAINER = 0
+KIND_TIM = 1
+KIND_ULZ = 2
+KIND_BIN = 3
+
+EXTENSIONS = {KIND_TIM: '.tim', KIND_ULZ: '.ulz', KIND_BIN: '.bin'}
+
+# magic, version, size and mtime of BPB and BPH, header hash, nodes
+INDEX_HEADER = struct.Struct('<4sIQQQQ16sI')
+# parent node (-1 for the top entries), position in the parent, kind,
+# absolute offset, size, crc32 of the data (0 for the containers)
+INDEX_NODE = struct.Struct('<iHBQII')
+INDEX_SIGNATURE = b'BPBI'
+INDEX_VERSION = 1
+
+
+@dataclasses.dataclass
+class IndexNode:
+    key: typing.Tuple[int, ...]
+    kind: int
+    offset: int
+    size: int
+    checksum: int = 0
+
+    @property
+    def path(self) -> str:
+        name = '/'.join(f'{idx:04d}' for idx in self.key)
+        return name + EXTENSIONS.get(self.kind, '')
+
+    @property
+    def is_dir(self) -> bool:
+        return self.kind == KIND_CONTAINER
+
+
+def index_stamp(bpb: pathlib.Path, bph: pathlib.Path) -> tuple:
+    """
+    What makes an index still valid: size and mtime of both files and
+    a hash of the BPH plus the first sector of the BPB
+    """
+    bpb_stat = bpb.stat()
+    bph_stat = bph.stat()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(bph.read_bytes())
+    with bpb.open('rb') as bpb_file:
+        digest.update(bpb_file.read(0x800))
+    return (
+        bpb_stat.st_size,
+        bpb_stat.st_mtime_ns,
+        bph_stat.st_size,
+        bph_stat.st_mtime_ns,
+        digest.digest()
+    )
+
+
+def probe_nodes(bpb_view, key, offset: int, size: int) -> typing.List[IndexNode]:
+    """
+    The node of a piece of the BPB followed by all the nodes inside it
+    """
+    chunks = probe_container(bpb_view, offset, size)
+    if chunks is None:
+        kind = {'.tim': KIND_TIM, '.ulz': KIND_ULZ}.get(leaf_extension(bpb_view, offset, size), KIND_BIN)
+        with bpb_view[offset:offset + size] as chunk:
+            return [IndexNode(key, kind, offset, size, zlib.crc32(chunk))]
+
+    nodes = [IndexNode(key, KIND_CONTAINER, offset, size)]
+    for idx, (chunk_offset, chunk_size) in enumerate(chunks):
+        nodes += probe_nodes(bpb_view, key + (idx,), chunk_offset, chunk_size)
+    return nodes
+
+
+class BpbIndex:
+    """
+    The layout of the whole ACE.BPB, every container and file with its
+    offset, size, kind and crc32, in the same order of the unpacked
+    tree. Probing the nested containers means reading most of the BPB,
+    the index is saved in a small binary file and loaded back as long
+    as BPB and BPH did not change.
+    """
+
+    def __init__(self, stamp: tuple, nodes: typing.List[IndexNode]):
+        self.stamp = stamp
+        self.nodes = nodes
+
+    @classmethod
+    def build(cls, bpb: pathlib.Path, bph: pathlib.Path) -> 'BpbIndex':
+        bpb = pathlib.Path(bpb)
+        bph = pathlib.Path(bph)
+        stamp = index_stamp(bpb, bph)
+        nodes = []
+        with bpb.open('rb') as bpb_file, \
+                mmap.mmap(bpb_file.fileno(), 0, access=mmap.ACCESS_READ) as bpb_map, \
+                memoryview(bpb_map) as bpb_view:
+            for idx, (offset, size) in enumerate(read_bph(bph)):
+                nodes += probe_nodes(bpb_view, (idx,), offset, size)
+
+        return cls(stamp, nodes)
+
+    def refresh(self, bpb: pathlib.Path, bph: pathlib.Path, changed: typing.Iterable[int]):
+        """
+        Probes again only the top entries rewritten in the BPB, the
+        others are kept as they are
+        """
+        bpb = pathlib.Path(bpb)
+        bph = pathlib.Path(bph)
+        changed = set(changed)
+        kept = {}
+        for node in self.nodes:
+            kept.setdefault(node.key[0], []).append(node)
+
+        nodes = []
+        with bpb.open('rb') as bpb_file, \
+                mmap.mmap(bpb_file.fileno(), 0, access=mmap.ACCESS_READ) as bpb_map, \
+                memoryview(bpb_map) as bpb_view:
+            for idx, (offset, size) in enumerate(read_bph(bph)):
+                if idx in changed or idx not in kept:
+                    nodes += probe_nodes(bpb_view, (idx,), offset, size)
+                else:
+                    nodes += kept[idx]
+
+        self.nodes = nodes
+        self.stamp = index_stamp(bpb, bph)
+
+    @classmethod
+    def load(cls, index_path: pathlib.Path, bpb: pathlib.Path, bph: pathlib.Path) -> typing.Optional['BpbIndex']:
+        """
+        Reads the index, None when it's missing, broken or stale
+        """
+        try:
+            data = pathlib.Path(index_path).read_bytes()
+            signature, version, *stamp, count = INDEX_HEADER.unpack_from(data)
+        except (OSError, struct.error):
+            return None
+
+        if signature != INDEX_SIGNATURE or version != INDEX_VERSION:
+            logging.debug('not a bpb index ' + str(index_path))
+            return None
+
+        if tuple(stamp) != index_stamp(pathlib.Path(bpb), pathlib.Path(bph)):
+            logging.debug('stale bpb index ' + str(index_path))
+            return None
+
+        nodes = []
+        try:
+            for parent, idx, kind, offset, size, checksum in INDEX_NODE.iter_unpack(
+                    data[INDEX_HEADER.size:INDEX_HEADER.size + count * INDEX_NODE.size]):
+                key = (nodes[parent].key if parent >= 0 else ()) + (idx,)
+                nodes.append(IndexNode(key, kind, offset, size, checksum))
+        except (struct.error, IndexError):
+            return None
+
+        if len(nodes) != count:
+            return None
+
+        return cls(tuple(stamp), nodes)
+
+    def save(self, index_path: pathlib.Path):
+        """
+        Writes the index to a temporary file and renames it
+        """
+        index_path = pathlib.Path(index_path)
+        positions = {}
+        data = [INDEX_HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, *self.stamp, len(self.nodes))]
+        for position, node in enumerate(self.nodes):
+            positions[node.key] = position
+            data.append(INDEX_NODE.pack(
+                positions.get(node.key[:-1], -1),
+                node.key[-1],
+                node.kind,
+                node.offset,
+                node.size,
+                node.checksum
+            ))
+
+        fd, tmp_name = tempfile.mkstemp(dir=str(index_path.parent), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(b''.join(data))
+            os.replace(tmp_name, str(index_path))
+        except OSError:
+            os.unlink(tmp_name)
+            raise
+
+    def children(self) -> dict:
+        """
+        The chunks of every node, as BpbArchive keeps them: the key is
+        the tuple of indexes, the value the list of (offset, size) or
+        None for the files
+        """
+        found = {(): []}
+        for node in self.nodes:
+            found[node.key[:-1]].append((node.offset, node.size))
+            found[node.key] = [] if node.is_dir else None
+        return found
+
+    def files(self) -> typing.List[IndexNode]:
+        return [node for node in self.nodes if not node.is_dir]
+
+
+def default_index_path(bpb: pathlib.Path) -> pathlib.Path:
+    bpb = pathlib.Path(bpb)
+    return bpb.with_name(bpb.name + '.idx')
+
+
+def load_index(bpb: pathlib.Path, bph: pathlib.Path, index_path: pathlib.Path = None) -> BpbIndex:
+    """
+    Loads the index next to the BPB, when it's missing or stale the
+    BPB is probed again and the index saved
+    """
+    if index_path is None:
+        index_path = default_index_path(bpb)
+
+    index = BpbIndex.load(index_path, bpb, bph)
+    if index is None:
+        index = BpbIndex.build(bpb, bph)
+        try:
+            index.save(index_path)
+        except OSError as e:
+            logging.warning('cannot save the bpb index {}: {}'.format(index_path, e))
+
+    return index
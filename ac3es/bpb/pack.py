@@ -19,6 +19,11 @@ import dataclasses
 import typing
 import struct
 import pathlib
+import zlib
+
+from ac3es.bpb.unpack import read_bph
+
+SECTOR_SIZE = 0x800
 
 
 @dataclasses.dataclass
@@ -34,14 +39,7 @@ def pack_recursive(root_dir: pathlib.Path) -> BPBData:
         if entry.name.startswith('.'):
             continue
 
-        if entry.is_dir():
-            bpb_chunk = pack_recursive(entry)
-            chunks.append(
-                bpb_chunk.header + b''.join(bpb_chunk.offsets) + b''.join(bpb_chunk.chunks)
-            )
-        else:
-            with entry.open('rb') as f:
-                chunks.append(f.read())
+        chunks.append(pack_entry(entry))
 
     header = struct.pack('<I', len(chunks))
     start_offset = 4 + len(chunks) * 4
@@ -56,6 +54,158 @@ def pack_recursive(root_dir: pathlib.Path) -> BPBData:
     return BPBData(header=header, offsets=offsets, chunks=chunks)
 
 
+def pack_entry(entry: pathlib.Path) -> bytes:
+    """
+    The data of a file or of a whole directory packed as a container
+    """
+    if entry.is_dir():
+        bpb_chunk = pack_recursive(entry)
+        return bpb_chunk.header + b''.join(bpb_chunk.offsets) + b''.join(bpb_chunk.chunks)
+
+    with entry.open('rb') as f:
+        return f.read()
+
+
+def list_entries(root_dir: pathlib.Path) -> typing.List[pathlib.Path]:
+    return [entry for entry in sorted(root_dir.iterdir()) if not entry.name.startswith('.')]
+
+
+def tree_files(entry: pathlib.Path, key: typing.Tuple[int, ...]):
+    """
+    The files under entry as (key, path), the key is the position
+    they get in the nested containers, same as in BpbIndex
+    """
+    if not entry.is_dir():
+        yield key, entry
+        return
+
+    for idx, child in enumerate(list_entries(entry)):
+        yield from tree_files(child, key + (idx,))
+
+
+def same_as_index(entry: pathlib.Path, idx: int, nodes) -> bool:
+    """
+    Compares the files of a top entry with its files in the index,
+    size first and then crc32
+    """
+    files = list(tree_files(entry, (idx,)))
+    if [key for key, _ in files] != [node.key for node in nodes]:
+        return False
+
+    for (_, path), node in zip(files, nodes):
+        if path.stat().st_size != node.size:
+            return False
+        if zlib.crc32(path.read_bytes()) != node.checksum:
+            return False
+
+    return True
+
+
+def sectors(size: int) -> int:
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+def repack_files(source_path: pathlib.Path, dest_bpb: pathlib.Path, dest_bph: pathlib.Path, index=None):
+    """
+    Writes into an existing ACE.BPB/BPH only the top entries of the
+    tree that are different from the BPB.
+
+    An entry that still fits in its sectors is written in place, a
+    bigger one goes in the first free sectors, the ones left by an
+    entry moved before or after the last entry, and its record in the
+    BPH is updated. The tree can have more entries than the BPH, they
+    get a new record and go in the first free sectors too.
+
+    With a BpbIndex of the BPB the files are compared with the crc32
+    in the index and the unchanged entries are not packed at all, the
+    index is refreshed afterward.
+
+    :return: list of (entry, sector, action) of the entries written,
+        action is 'patch' when written in place, 'move' or 'new'
+    """
+    if not source_path.is_dir():
+        raise Exception(f'{source_path} is not a directory!')
+
+    entries = read_bph(dest_bph)
+    tree = list_entries(source_path)
+    if len(tree) < len(entries):
+        raise Exception(f'{source_path} has {len(tree)} entries but the BPH {len(entries)}, pack it from scratch')
+
+    indexed = {}
+    if index is not None:
+        for node in index.files():
+            indexed.setdefault(node.key[0], []).append(node)
+
+    # sectors used by every entry as [start, end)
+    used = {
+        idx: (offset // SECTOR_SIZE, offset // SECTOR_SIZE + sectors(size))
+        for idx, (offset, size) in enumerate(entries)
+    }
+
+    old_end = max([0] + [end for _, end in used.values()])
+    bph_data = bytearray(dest_bph.read_bytes())
+    written = []
+    with dest_bpb.open('r+b') as bpb:
+        for idx, entry in enumerate(tree):
+            if idx < len(entries) and idx in indexed and same_as_index(entry, idx, indexed[idx]):
+                continue
+
+            chunk = pack_entry(entry)
+            if idx < len(entries):
+                offset, size = entries[idx]
+                bpb.seek(offset)
+                if len(chunk) >> 2 << 2 == size and bpb.read(len(chunk)) == chunk:
+                    continue
+
+            need = sectors(len(chunk))
+            others = [span for other, span in used.items() if other != idx]
+
+            def is_free(start):
+                return all(end <= start or begin >= start + need for begin, end in others)
+
+            if idx in used and is_free(used[idx][0]):
+                sector = used[idx][0]
+            else:
+                # the end of the last entry is always free
+                sector = min(end for end in [0] + [end for _, end in others] if is_free(end))
+
+            if idx not in used:
+                action = 'new'
+            elif sector != used[idx][0]:
+                action = 'move'
+            else:
+                action = 'patch'
+            written.append((idx, sector, action))
+            used[idx] = (sector, sector + need)
+
+            bpb.seek(sector * SECTOR_SIZE)
+            bpb.write(chunk)
+            if len(chunk) % SECTOR_SIZE > 0:
+                bpb.write(b'\x00' * (SECTOR_SIZE - (len(chunk) % SECTOR_SIZE)))
+
+            record = 20 + idx * 8
+            if record >= len(bph_data):
+                bph_data += b'\x00' * 8
+                flags = 0xE0000000
+            else:
+                flags = struct.unpack_from('<I', bph_data, record)[0] & 0xFF000000
+            struct.pack_into('<II', bph_data, record, len(chunk) >> 2 | flags, sector)
+
+        # an entry moved away from the end or shrunk leaves some sectors
+        # behind, unless the BPB goes on after the entries
+        new_end = max([0] + [end for _, end in used.values()])
+        if new_end < old_end and bpb.seek(0, 2) <= old_end * SECTOR_SIZE:
+            bpb.truncate(new_end * SECTOR_SIZE)
+
+    if written:
+        struct.pack_into('<I', bph_data, 16, len(tree))
+        dest_bph.write_bytes(bph_data)
+        if index is not None:
+            index.refresh(dest_bpb, dest_bph, [idx for idx, _, _ in written])
+
+    return written
+
+
 def pack_files(source_path: pathlib.Path, dest_bpb: pathlib.Path, dest_bph: pathlib.Path):
     if not source_path.is_dir():
         raise Exception(f'{source_path} is not a directory!')
@@ -15,12 +15,18 @@
 #  You should have received a copy of the GNU General Public License
 #  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import filecmp
+import os
 import pathlib
+import shutil
 import tempfile
 import unittest
+import unittest.mock
 from ac3es.bpb import pack
 from ac3es.bpb import unpack
+from ac3es.bpb.archive import BpbArchive
+from ac3es.bpb.index import BpbIndex, load_index
 
 
 class TestBPB(unittest.TestCase):
@@ -30,6 +36,21 @@ class TestBPB(unittest.TestCase):
         self.test_bpb = pathlib.Path(__file__).parent.joinpath('T_ACE.BPB')
         self.test_bph = pathlib.Path(__file__).parent.joinpath('T_ACE.BPH')
 
+    def make_packed_tree(self, tmp_dir_path):
+        """
+        A tree with a nested container, packed into ACE.BPB/BPH
+        """
+        source = tmp_dir_path.joinpath('source')
+        source.joinpath('0000', '0001').mkdir(parents=True)
+        shutil.copy(self.assets_dir.joinpath('lulu.tim'), source.joinpath('0000', '0000.tim'))
+        shutil.copy(self.assets_dir.joinpath('occhietto_big.ulz'), source.joinpath('0000', '0001', '0000.ulz'))
+        shutil.copy(self.assets_dir.joinpath('matisse.tim'), source.joinpath('0000', '0001', '0001.tim'))
+        shutil.copy(self.assets_dir.joinpath('occhietto.tim'), source.joinpath('0001.tim'))
+        some_bpb = tmp_dir_path.joinpath('ACE.BPB')
+        some_bph = tmp_dir_path.joinpath('ACE.BPH')
+        pack.pack_files(source, some_bpb, some_bph)
+        return source, some_bpb, some_bph
+
     def test_pack(self):
         with tempfile.TemporaryDirectory() as tmp_dir:
             tmp_dir_path = pathlib.Path(tmp_dir)
@@ -47,3 +68,164 @@ class TestBPB(unittest.TestCase):
             test_assets = ['lulu.tim', 'matisse.tim', 'occhietto.tim', 'occhietto_big.ulz']
             for found in tmp_dir_path.iterdir():
                 self.assertTrue(filecmp.cmp(found, self.assets_dir.joinpath(test_assets.pop()), False))
+
+    def test_unpack_nested(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir_path = pathlib.Path(tmp_dir)
+            source, some_bpb, some_bph = self.make_packed_tree(tmp_dir_path)
+
+            dest = tmp_dir_path.joinpath('dest')
+            self.assertEqual(unpack.unpack_files(dest, some_bpb, some_bph), 2)
+            expected = sorted(x.relative_to(source) for x in source.rglob('*'))
+            self.assertEqual(sorted(x.relative_to(dest) for x in dest.rglob('*')), expected)
+            for path in expected:
+                if source.joinpath(path).is_file():
+                    self.assertTrue(filecmp.cmp(source.joinpath(path), dest.joinpath(path), False), path)
+
+            # without a file descriptor the data is written from the mapping
+            out_path = tmp_dir_path.joinpath('chunk.bin')
+            with out_path.open('wb') as out_file:
+                unpack.copy_chunk(out_file, some_bpb.read_bytes(), 0x800, 100)
+            self.assertEqual(out_path.read_bytes(), some_bpb.read_bytes()[0x800:0x800 + 100])
+
+            # copy_file_range can't copy between these files, sendfile can
+            if hasattr(os, 'copy_file_range') and hasattr(os, 'sendfile'):
+                with unittest.mock.patch('os.copy_file_range', side_effect=OSError(errno.EXDEV, 'cross device')), \
+                        unittest.mock.patch('os.sendfile', wraps=os.sendfile) as sendfile, \
+                        some_bpb.open('rb') as bpb_file, \
+                        out_path.open('wb') as out_file:
+                    unpack.copy_chunk(out_file, None, 0x800, 100, bpb_file.fileno())
+                self.assertTrue(sendfile.called)
+                self.assertEqual(out_path.read_bytes(), some_bpb.read_bytes()[0x800:0x800 + 100])
+
+    def test_unpack_jobs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir_path = pathlib.Path(tmp_dir)
+            single = tmp_dir_path.joinpath('single')
+            parallel = tmp_dir_path.joinpath('parallel')
+            self.assertEqual(unpack.unpack_files(single, self.test_bpb, self.test_bph), 4)
+            self.assertEqual(unpack.unpack_files(parallel, self.test_bpb, self.test_bph, 3), 4)
+
+            files = sorted(x.relative_to(single) for x in single.rglob('*'))
+            self.assertEqual(sorted(x.relative_to(parallel) for x in parallel.rglob('*')), files)
+            for path in files:
+                self.assertTrue(filecmp.cmp(single.joinpath(path), parallel.joinpath(path), False), path)
+
+    def test_archive(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir_path = pathlib.Path(tmp_dir)
+            source, some_bpb, some_bph = self.make_packed_tree(tmp_dir_path)
+
+            with BpbArchive(some_bpb, some_bph) as archive:
+                self.assertEqual(archive.listdir(), ['0000', '0001.tim'])
+                self.assertEqual(archive.listdir('0000/0001'), ['0000.ulz', '0001.tim'])
+                self.assertTrue(archive.stat('0000/0001').is_dir)
+
+                node = archive.stat('0000/0001/0000')
+                self.assertEqual((node.path, node.extension, node.size), ('0000/0001/0000', '.ulz', 46612))
+
+                data = archive.read('0000/0001/0001.tim')
+                self.assertEqual(data, source.joinpath('0000', '0001', '0001.tim').read_bytes())
+                data.release()
+
+                with archive.open('0001') as f:
+                    self.assertEqual(f.read(4), b'\x10\x00\x00\x00')
+                    f.seek(0)
+                    self.assertEqual(f.read(), source.joinpath('0001.tim').read_bytes())
+
+                self.assertEqual(
+                    [x.path + x.extension for x in archive.walk()],
+                    ['0000/0000.tim', '0000/0001/0000.ulz', '0000/0001/0001.tim', '0001.tim']
+                )
+
+                with self.assertRaises(FileNotFoundError):
+                    archive.stat('0000/0002')
+                with self.assertRaises(FileNotFoundError):
+                    archive.stat('0001/0000')
+                with self.assertRaises(NotADirectoryError):
+                    archive.listdir('0001')
+                with self.assertRaises(IsADirectoryError):
+                    archive.read('0000')
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir_path = pathlib.Path(tmp_dir)
+            source, some_bpb, some_bph = self.make_packed_tree(tmp_dir_path)
+
+            index_path = tmp_dir_path.joinpath('ACE.BPB.idx')
+            self.assertIsNone(BpbIndex.load(index_path, some_bpb, some_bph))
+            index = load_index(some_bpb, some_bph)
+            self.assertTrue(index_path.is_file())
+            self.assertEqual(
+                [x.path for x in index.files()],
+                ['0000/0000.tim', '0000/0001/0000.ulz', '0000/0001/0001.tim', '0001.tim']
+            )
+
+            loaded = BpbIndex.load(index_path, some_bpb, some_bph)
+            self.assertEqual(loaded.stamp, index.stamp)
+            self.assertEqual(loaded.nodes, index.nodes)
+
+            with BpbArchive(some_bpb, some_bph, loaded) as archive, \
+                    BpbArchive(some_bpb, some_bph) as probed:
+                self.assertEqual(list(archive.walk()), list(probed.walk()))
+                self.assertEqual(archive.listdir('0000'), probed.listdir('0000'))
+
+            single = tmp_dir_path.joinpath('single')
+            indexed = tmp_dir_path.joinpath('indexed')
+            unpack.unpack_files(single, some_bpb, some_bph)
+            unpack.unpack_files(indexed, some_bpb, some_bph, 2, loaded)
+            files = sorted(x.relative_to(single) for x in single.rglob('*'))
+            self.assertEqual(sorted(x.relative_to(indexed) for x in indexed.rglob('*')), files)
+            for path in files:
+                if single.joinpath(path).is_file():
+                    self.assertTrue(filecmp.cmp(single.joinpath(path), indexed.joinpath(path), False), path)
+
+            # a newer BPB makes the index stale
+            stat = some_bpb.stat()
+            os.utime(some_bpb, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+            self.assertIsNone(BpbIndex.load(index_path, some_bpb, some_bph))
+            self.assertEqual(load_index(some_bpb, some_bph).nodes, index.nodes)
+            self.assertIsNotNone(BpbIndex.load(index_path, some_bpb, some_bph))
+
+    def test_repack(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir_path = pathlib.Path(tmp_dir)
+            source, some_bpb, some_bph = self.make_packed_tree(tmp_dir_path)
+            self.assertEqual(pack.repack_files(source, some_bpb, some_bph), [])
+
+            # same size, written in place, same as packing from scratch
+            tim = bytearray(source.joinpath('0000', '0001', '0001.tim').read_bytes())
+            tim[-4:] = b'\xff\xff\xff\xff'
+            source.joinpath('0000', '0001', '0001.tim').write_bytes(tim)
+            self.assertEqual(pack.repack_files(source, some_bpb, some_bph), [(0, 0, 'patch')])
+            full_bpb = tmp_dir_path.joinpath('FULL.BPB')
+            full_bph = tmp_dir_path.joinpath('FULL.BPH')
+            pack.pack_files(source, full_bpb, full_bph)
+            self.assertEqual(some_bpb.read_bytes(), full_bpb.read_bytes())
+            self.assertEqual(some_bph.read_bytes(), full_bph.read_bytes())
+
+            # a bigger entry goes after the last one, the new entry takes
+            # the sectors it left
+            index = load_index(some_bpb, some_bph)
+            end_sector = some_bpb.stat().st_size // 0x800
+            with source.joinpath('0000', '0000.tim').open('ab') as f:
+                f.write(b'\x00' * 0x2000)
+            shutil.copy(self.assets_dir.joinpath('lulu.tim'), source.joinpath('0002.tim'))
+            written = pack.repack_files(source, some_bpb, some_bph, index)
+            self.assertEqual(written, [(0, end_sector, 'move'), (2, 0, 'new')])
+            self.assertEqual(index.nodes, BpbIndex.build(some_bpb, some_bph).nodes)
+            self.assertEqual(pack.repack_files(source, some_bpb, some_bph, index), [])
+
+            dest = tmp_dir_path.joinpath('dest')
+            self.assertEqual(unpack.unpack_files(dest, some_bpb, some_bph), 3)
+            expected = sorted(x.relative_to(source) for x in source.rglob('*'))
+            self.assertEqual(sorted(x.relative_to(dest) for x in dest.rglob('*')), expected)
+            for path in expected:
+                if source.joinpath(path).is_file():
+                    self.assertTrue(filecmp.cmp(source.joinpath(path), dest.joinpath(path), False), path)
+
+            # a smaller last entry stays where it is and the BPB shrinks
+            source.joinpath('0000', '0000.tim').write_bytes(b'\x10\x00\x00\x00' * 0x100)
+            self.assertEqual(pack.repack_files(source, some_bpb, some_bph), [(0, end_sector, 'patch')])
+            offset, size = unpack.read_bph(some_bph)[0]
+            self.assertEqual(some_bpb.stat().st_size, pack.sectors(offset + size) * 0x800)
@@ -15,17 +15,45 @@
 #  You should have received a copy of the GNU General Public License
 #  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import mmap
+import os
 import pathlib
+import struct
 from ac3es.exceptions import BinDetectException, CliException
 
 
-def unpack_files(dest_path: pathlib.Path, bpb: pathlib.Path, bph: pathlib.Path) -> int:
+def read_bph(bph: pathlib.Path):
     """
-    Unpack ACE.BPB and ACE.BPH in a given directory
+    The entries of ACE.BPH as a list of (offset, size) in the BPB
+    """
+    data = bph.read_bytes()
+    num_entries = int.from_bytes(data[16:20], byteorder='little')
+    entries = []
+    for raw_size, sector in struct.iter_unpack('<II', data[20:20 + num_entries * 8]):
+        entries.append((sector * 0x800, (raw_size & 0xFFFFFF) << 2))
+    return entries
+
+
+def unpack_files(dest_path: pathlib.Path, bpb: pathlib.Path, bph: pathlib.Path, max_workers: int = 1,
+                 index=None) -> int:
+    """
+    Unpack ACE.BPB and ACE.BPH in a given directory, the BPB is
+    mapped in memory and never read in pieces
+
+    The top level entries are independent, with max_workers they are
+    unpacked by a pool of threads sharing the same mapping, the copies
+    are done by the kernel so the threads don't wait for each other.
+    Every entry has its own directory, the result is the same.
+
+    With a BpbIndex the containers are not probed, the files are copied
+    straight from the offsets in the index.
 
     :param dest_path: Directory to unpack
     :param bpb: ACE.BPB path
     :param bph: ACE.BPH path
+    :param max_workers: how many entries to unpack at the same time
+    :param index: BpbIndex of the same BPB, optional
     :return:
     """
 
@@ -38,80 +66,147 @@ def unpack_files(dest_path: pathlib.Path, bpb: pathlib.Path, bph: pathlib.Path)
     if not bph.is_file():
         raise CliException('BPH {} is not a file or is inaccessible'.format(bpb.resolve()))
 
-    num_entries = None
-    with bpb.open('rb') as bpb, bph.open('rb') as bph:
-
-        # skip the header
-        bph.read(16)
-        num_entries = int.from_bytes(bph.read(4), byteorder='little')
-
-        for idx in range(num_entries):
-            raw_entry = bph.read(8)
-            size = int.from_bytes(raw_entry[:3], byteorder='little') << 2
-            position = int.from_bytes(raw_entry[4:], byteorder='little') * 0x800
+    entries = read_bph(bph)
+    indexed = {}
+    if index is not None:
+        for node in index.files():
+            indexed.setdefault(node.key[0], []).append(node)
+
+    with bpb.open('rb') as bpb_file, \
+            mmap.mmap(bpb_file.fileno(), 0, access=mmap.ACCESS_READ) as bpb_map, \
+            memoryview(bpb_map) as bpb_view:
+        def unpack_entry(idx):
+            if index is not None:
+                for node in indexed.get(idx, []):
+                    filename = dest_path.joinpath(node.path)
+                    filename.parent.mkdir(parents=True, exist_ok=True)
+                    with filename.open('wb') as part:
+                        copy_chunk(part, bpb_view, node.offset, node.size, bpb_file.fileno())
+                return
+
+            position, size = entries[idx]
             current_entry = dest_path / pathlib.Path(str(idx).zfill(4))
-            unpack_all(current_entry, bpb, position, size)
+            unpack_all(current_entry, bpb_view, position, size, bpb_file.fileno())
 
-    return num_entries
+        if max_workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+                # list() raises here the first error of the workers
+                list(executor.map(unpack_entry, range(len(entries))))
+        else:
+            for idx in range(len(entries)):
+                unpack_entry(idx)
 
+    return len(entries)
 
-def unpack_all(dest_dir: pathlib.Path, bpb, start_offset: int, size: int):
+
+def copy_chunk(out_file, bpb_view, offset: int, size: int, bpb_fd=None):
     """
-    Recursive function for unpacking chunks in BPB/BPH
-    :param dest_dir:
-    :param bpb:
-    :param start_offset:
-    :param size:
-    :return:
+    Writes a piece of the BPB into out_file, the kernel copies it
+    straight from the BPB with copy_file_range or sendfile when they
+    are available, otherwise it's written from the mapping without
+    any copy in between.
+    """
+    out_fd = out_file.fileno()
+    use_copy_file_range = bpb_fd is not None and hasattr(os, 'copy_file_range')
+    use_sendfile = bpb_fd is not None and hasattr(os, 'sendfile')
+
+    while (use_copy_file_range or use_sendfile) and size:
+        try:
+            if use_copy_file_range:
+                copied = os.copy_file_range(bpb_fd, out_fd, size, offset)
+            else:
+                copied = os.sendfile(out_fd, bpb_fd, offset, size)
+        except OSError:
+            # not supported between these files, sendfile is tried
+            # next and the mapping does the rest
+            if use_copy_file_range:
+                use_copy_file_range = False
+            else:
+                use_sendfile = False
+            continue
+        if not copied:
+            break
+        offset += copied
+        size -= copied
+
+    if size:
+        out_file.write(bpb_view[offset:offset + size])
+
+
+def probe_container(bpb_view, start_offset: int, size: int):
     """
-    bpb.seek(start_offset)
-    num_entries = int.from_bytes(bpb.read(4), byteorder='little')
+    Returns the list of (offset, size) of the chunks when the piece of
+    the BPB looks like a container, None when it's a file: a container
+    starts with less than 512 offsets, sorted and inside its size.
+    """
+    num_entries = int.from_bytes(bpb_view[start_offset:start_offset + 4], byteorder='little')
+    if not 0 < num_entries < 512:
+        return None
 
     try:
-        if 0 < num_entries < 512:
-            offsets = []
-            for i in range(num_entries):
-                offsets.append(int.from_bytes(bpb.read(4), byteorder='little'))
-            is_sorted = all(offsets[i] < offsets[i + 1] for i in range(len(offsets) - 1))
-
-            # let's check if we are dealing with another nested container
-            if not is_sorted:
-                raise BinDetectException('the list is not ordered ')
-            if start_offset + offsets[-1] > start_offset + size:
-                raise BinDetectException('chunk too big')
-
-            for idx, chunk_offset in enumerate(offsets):
-                chunk_size = None
-                try:
-                    chunk_size = offsets[idx + 1] - chunk_offset
-                except IndexError:
-                    chunk_size = size - chunk_offset
-
-                unpack_all(
-                    dest_dir.joinpath(f'{idx:04d}'),
-                    bpb,
-                    chunk_offset + start_offset,
-                    chunk_size
-                )
-
-            return
-    except BinDetectException:
+        offsets = struct.unpack_from('<{}I'.format(num_entries), bpb_view, start_offset + 4)
+        is_sorted = all(offsets[i] < offsets[i + 1] for i in range(len(offsets) - 1))
+
+        # let's check if we are dealing with another nested container
+        if not is_sorted:
+            raise BinDetectException('the list is not ordered ')
+        if start_offset + offsets[-1] > start_offset + size:
+            raise BinDetectException('chunk too big')
+    except (BinDetectException, struct.error):
         # if we get here chances are we not dealing with a container but with a file
-        # we silently jump to this part and carry on
-        pass
+        return None
+
+    chunks = []
+    for idx, chunk_offset in enumerate(offsets):
+        try:
+            chunk_size = offsets[idx + 1] - chunk_offset
+        except IndexError:
+            chunk_size = size - chunk_offset
+        chunks.append((chunk_offset + start_offset, chunk_size))
+
+    return chunks
+
 
-    bpb.seek(start_offset)
-    content = bpb.read(size)
+def leaf_extension(bpb_view, start_offset: int, size: int) -> str:
+    """
+    The extension of a file inside the BPB, from its first bytes
+    """
+    magic = bytes(bpb_view[start_offset:start_offset + min(4, size)])
 
     extension = '.bin'
-    if content[0:4] == b'\x10\x00\x00\x00':
+    if magic == b'\x10\x00\x00\x00':
         extension = '.tim'
-    elif content[0:4] == b'Ulz\x1A':
+    elif magic == b'Ulz\x1A':
         extension = '.ulz'
 
-    filename = dest_dir.with_suffix(extension)
+    return extension
+
+
+def unpack_all(dest_dir: pathlib.Path, bpb_view, start_offset: int, size: int, bpb_fd=None):
+    """
+    Recursive function for unpacking chunks in BPB/BPH
+    :param dest_dir:
+    :param bpb_view: memoryview of the whole BPB
+    :param start_offset:
+    :param size:
+    :param bpb_fd: file descriptor of the BPB, for copying in the kernel
+    :return:
+    """
+    chunks = probe_container(bpb_view, start_offset, size)
+    if chunks is not None:
+        for idx, (chunk_offset, chunk_size) in enumerate(chunks):
+            unpack_all(
+                dest_dir.joinpath(f'{idx:04d}'),
+                bpb_view,
+                chunk_offset,
+                chunk_size,
+                bpb_fd
+            )
+        return
+
+    filename = dest_dir.with_suffix(leaf_extension(bpb_view, start_offset, size))
 
     filename.parent.mkdir(parents=True, exist_ok=True)
 
     with filename.open('wb') as part:
-        part.write(content)
+        copy_chunk(part, bpb_view, start_offset, size, bpb_fd)
@@ -15,4 +15,5 @@
 #  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from ac3es.exceptions.exceptions import CliException, Ac3esException, BinDetectException, NotTimException
+from ac3es.exceptions.exceptions import CliException, Ac3esException, BinDetectException, NotTimException, \
+    UlzTooBigException
@@ -29,3 +29,7 @@ class NotTimException(Ac3esException):
 
 class BinDetectException(Ac3esException):
     pass
+
+
+class UlzTooBigException(Ac3esException):
+    pass
@@ -16,6 +16,7 @@
 
 from ac3es.cli.helpers import md5_for_file
 from ac3es.tim import TimReader
+from ac3es.ulz import UlzReader
 from ac3es.ulz.helpers import get_ulz_info
 from ac3es.data.database_md5 import DatabaseMD5
 from ac3es.exceptions import NotTimException
@@ -28,7 +29,10 @@ class InfoFile:
     db_md5 = DatabaseMD5()
 
     def detect(self, path):
-        if path[-3:] == 'ulz':
+        with open(path, 'rb') as f:
+            signature = f.read(4)
+
+        if signature == UlzReader.signature:
             return get_ulz_info(path)
 
         try:
@@ -16,6 +16,6 @@
 
 
 from ac3es.ulz.reader import UlzReader
-from ac3es.ulz.writer import UlzWriter
+from ac3es.ulz.writer import UlzWriter, compress_bytes, compress_best, compress_budget
 from ac3es.ulz import helpers
 from ac3es.ulz.cli import CliUlz
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#  This file is part of AC3ES Tools.
+#
+#  AC3ES Tools is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  AC3ES Tools is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import dataclasses
+import glob
+import pathlib
+import time
+import typing
+
+from ac3es.exceptions import CliException
+from ac3es.ulz.reader import UlzReader
+
+
+@dataclasses.dataclass
+class CompressJob:
+    input_file: pathlib.Path
+    output_file: typing.Optional[pathlib.Path] = None
+    like_file: typing.Optional[pathlib.Path] = None
+
+
+@dataclasses.dataclass
+class JobResult:
+    input_file: pathlib.Path
+    output_file: typing.Optional[pathlib.Path] = None
+    input_size: int = 0
+    output_size: int = 0
+    elapsed: float = 0.0
+    error: typing.Optional[str] = None
+
+
+def expand_inputs(patterns: typing.List[str]) -> typing.List[pathlib.Path]:
+    """
+    Turns the arguments from the command line into a list of files,
+    a directory gives all the files inside it but the ulz files left
+    by a previous run, a pattern the files matching it (useful where
+    the shell doesn't expand them).
+    """
+    inputs = []
+    for pattern in patterns:
+        path = pathlib.Path(pattern)
+        if path.is_dir():
+            inputs.extend(
+                sorted(
+                    x for x in path.iterdir()
+                    if x.is_file() and not x.name.startswith('.') and x.suffix.lower() != '.ulz'
+                )
+            )
+        elif path.exists():
+            inputs.append(path)
+        else:
+            matches = sorted(pathlib.Path(x) for x in glob.glob(pattern, recursive=True))
+            if not matches:
+                raise CliException('{} does not match any file'.format(pattern))
+            inputs.extend(x for x in matches if x.is_file())
+
+    return inputs
+
+
+def find_ulz_files(root_dir: pathlib.Path) -> typing.List[pathlib.Path]:
+    """
+    Walks a directory tree and returns the files starting with the ulz
+    signature, whatever their extension is.
+    """
+    found = []
+    for path in sorted(root_dir.rglob('*')):
+        if not path.is_file():
+            continue
+        with path.open('rb') as f:
+            if f.read(4) == UlzReader.signature:
+                found.append(path)
+
+    return found
+
+
+def read_job_list(list_path: pathlib.Path) -> typing.List[CompressJob]:
+    """
+    Reads a text file with a job on each line, the input file followed
+    optionally by the output file and the file to copy the parameters
+    from, separated by tabs. Relative paths start from the list file.
+    """
+    try:
+        lines = list_path.read_text().split("\n")
+    except IOError as err:
+        raise CliException("Error reading the file {0}: {1}".format(list_path, err))
+
+    def resolve(name):
+        if not name.strip():
+            return None
+        path = pathlib.Path(name.strip())
+        return path if path.is_absolute() else list_path.parent.joinpath(path)
+
+    jobs = []
+    for line in lines:
+        if not line.strip():
+            continue
+        fields = (line.split("\t") + ['', ''])[:3]
+        jobs.append(CompressJob(*[resolve(x) for x in fields]))
+
+    return jobs
+
+
+def run_jobs(worker: typing.Callable, jobs: typing.List, max_workers: int = 1) -> typing.Iterator[JobResult]:
+    """
+    Runs the worker on every job, with more than one worker the jobs
+    are spread over a pool of processes. The results come back in the
+    same order of the jobs.
+    """
+    if max_workers <= 1 or len(jobs) <= 1:
+        yield from map(worker, jobs)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(worker, jobs)
+
+
+def report(results: typing.Iterable[JobResult], verb='compressed') -> typing.List[JobResult]:
+    """
+    Prints a line for every result as soon as it's ready, then a
+    summary with the throughput, the skipped files are counted apart
+    and left out of it. Returns the results.
+    """
+    start = time.perf_counter()
+    done = []
+    for result in results:
+        done.append(result)
+        if result.error:
+            print('ERROR {} {}'.format(result.input_file, result.error))
+        elif result.output_file is None:
+            print('SKIP  {}'.format(result.input_file))
+        else:
+            print('OK    {} -> {} {} -> {} bytes {:.2f}s'.format(
+                result.input_file,
+                result.output_file,
+                result.input_size,
+                result.output_size,
+                result.elapsed
+            ))
+
+    elapsed = time.perf_counter() - start
+    processed = [x for x in done if not x.error and x.output_file is not None]
+    input_size = sum(x.input_size for x in processed)
+    output_size = sum(x.output_size for x in processed)
+    errors = sum(1 for x in done if x.error)
+    print('{} {} files, {} skipped, {} errors, {} -> {} bytes in {:.2f}s ({:.1f} KiB/s)'.format(
+        verb.capitalize(),
+        len(processed),
+        len(done) - len(processed) - errors,
+        errors,
+        input_size,
+        output_size,
+        elapsed,
+        input_size / 1024 / elapsed if elapsed else 0
+    ))
+
+    return done
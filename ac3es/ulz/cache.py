@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#  This file is part of AC3ES Tools.
+#
+#  AC3ES Tools is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  AC3ES Tools is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+
+from ac3es.ulz.reader import UlzReader
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
+
+
+def file_mode():
+    """
+    The mode of a new file for the current umask, mkstemp makes them
+    readable only by the owner
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+class CompressionCache:
+    """
+    Keeps the compressed ulz files on disk, the name of each file is
+    the hash of the uncompressed data plus the compression parameters,
+    so the same TIM compressed again gets the very same bytes back.
+
+    When the cache grows over max_size the files not used for the
+    longest time are removed, a hit touches the file so its mtime
+    tells when it was used the last time.
+
+    Entries are written to a temporary file and then renamed, more
+    processes can share the same directory.
+
+    The total size of the entries is kept in the file size inside the
+    directory, every process adds its own entries to it holding the
+    lock file, so the directory is scanned again only when the total
+    goes over max_size.
+    """
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.total_size = None
+
+    @staticmethod
+    def key(data, ulz_type, nbits, strategy='greedy', store_only=False):
+        """
+        The name of the entry, nbits can be best too
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if store_only:
+            strategy = 'store'
+        return '{}-{}-{}-{}'.format(digest, ulz_type, nbits, strategy)
+
+    def entry_path(self, key):
+        return self.directory.joinpath(key[:2], key + '.ulz')
+
+    def get(self, key):
+        """
+        Returns the ulz file stored for the key, None when missing
+        """
+        path = self.entry_path(key)
+        try:
+            ulz_data = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            return None
+
+        if ulz_data[:4] != UlzReader.signature:
+            logging.debug('broken cache entry ' + str(path))
+            return None
+
+        logging.debug('cache hit ' + key)
+        return ulz_data
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Holds the lock of the directory, shared by all the processes
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self.directory.joinpath('lock').open('a+b') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def read_total(self):
+        """
+        The size of all the entries, None if it was never counted
+        """
+        try:
+            return int(self.directory.joinpath('size').read_text())
+        except (OSError, ValueError):
+            return None
+
+    def write_total(self, total):
+        self.total_size = total
+        self.directory.joinpath('size').write_text(str(total))
+
+    def put(self, key, ulz_data):
+        """
+        Stores the ulz file and removes the oldest entries if the cache
+        is too big
+        """
+        path = self.entry_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, tmp_name = tempfile.mkstemp(dir=str(path.parent), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(ulz_data)
+            os.chmod(tmp_name, file_mode())
+        except OSError:
+            os.unlink(tmp_name)
+            raise
+
+        with self.locked():
+            try:
+                replaced = path.stat().st_size
+            except OSError:
+                replaced = 0
+
+            try:
+                os.replace(tmp_name, str(path))
+            except OSError:
+                os.unlink(tmp_name)
+                raise
+
+            total = self.read_total()
+            if total is None:
+                self.evict()
+                return
+
+            total += len(ulz_data) - replaced
+            if total > self.max_size:
+                self.evict()
+            else:
+                self.write_total(total)
+
+    def entries(self):
+        """
+        All the entries as (last use, size, path)
+        """
+        found = []
+        for path in self.directory.glob('*/*.ulz'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            found.append((stat.st_mtime, stat.st_size, path))
+        return found
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits
+        in max_size and counts again the total, call it holding the
+        lock
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda x: x[0]):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+        self.write_total(total)
@@ -14,14 +14,16 @@
 #  You should have received a copy of the GNU General Public License
 #  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
 
-import io
-import os
+import functools
 import pathlib
-import tempfile
-from ac3es.exceptions import CliException
+import time
+from ac3es.exceptions import CliException, UlzTooBigException
 from ac3es.cli import helpers
 from ac3es.cli import BaseCliCommand
-from ac3es.ulz import UlzReader, UlzWriter
+from ac3es.ulz import UlzReader, UlzWriter, compress_best, compress_budget
+from ac3es.ulz import batch
+from ac3es.ulz.cache import CompressionCache
+from ac3es.ulz.writer import DEFAULT_EFFORT
 
 
 class CliUlz(BaseCliCommand):
@@ -38,7 +40,16 @@ class CliUlz(BaseCliCommand):
             '--compress',
             '-c',
             metavar=('FILE'),
-            help='Compress a file in ULZ format, recompress the file if already compressed.'
+            nargs='+',
+            help='Compress files in ULZ format, recompress the file if already compressed. '
+                 'Accepts more files, directories and patterns.'
+        )
+
+        sub_ulz.add_argument(
+            '--compress-list',
+            metavar=('LIST'),
+            help='Compress the files from a list, each line has the input file and optionally '
+                 'the output file and the file to copy the parameters from, separated by tabs'
         )
 
         compression = parser_ulz.add_argument_group('compression')
@@ -52,9 +63,28 @@ class CliUlz(BaseCliCommand):
         compression.add_argument(
             '--level',
             '-l',
-            choices=(1, 2, 4, 8),
+            choices=(1, 2, 4, 8, 'best'),
+            type=compression_level,
+            help='Compression levels 1/2/4/8 uses a search buffer 1024/2048/4096/8192 bytes long, '
+                 'best tries all of them and keeps the smallest file.'
+        )
+
+        compression.add_argument(
+            '--strategy',
+            choices=('fast', 'greedy', 'lazy', 'optimal'),
+            help='How much effort to put in the compression, fast is the quickest but makes bigger files, '
+                 'lazy is a bit slower than greedy but compress better, '
+                 'optimal is the slowest but makes the smallest files, greedy is the default'
+        )
+
+        compression.add_argument(
+            '--effort',
+            '-e',
+            choices=range(10),
             type=int,
-            help='Compression levels 1/2/4/8 uses a search buffer 1024/2048/4096/8192 bytes long.'
+            metavar='{0..9}',
+            help='Speed against size, 0 is the fastest and 9 makes the smallest files, it chooses the strategy too. '
+                 '0 is the same of --strategy fast, 5 of --strategy greedy'
         )
 
         compression.add_argument(
@@ -69,6 +99,29 @@ class CliUlz(BaseCliCommand):
             help='Get compression parameters from file'
         )
 
+        compression.add_argument(
+            '--max-size',
+            metavar='BYTES',
+            type=lambda x: int(x, 0),
+            help='Biggest ulz file allowed, when it does not fit stronger efforts and bigger levels are tried, '
+                 'decimal or 0x hexadecimal'
+        )
+
+        compression.add_argument(
+            '--cache-dir',
+            metavar='DIRECTORY',
+            help='Keep the compressed files in a cache, the same data compressed again '
+                 'with the same parameters is taken from there'
+        )
+
+        compression.add_argument(
+            '--cache-size',
+            metavar='MIB',
+            type=int,
+            default=256,
+            help='Maximum size of the cache in MiB, the files not used for longer are removed first'
+        )
+
         sub_ulz.add_argument(
             '--decompress',
             '-d',
@@ -76,6 +129,19 @@ class CliUlz(BaseCliCommand):
             help='decompress the file in the current directory'
         )
 
+        sub_ulz.add_argument(
+            '--decompress-tree',
+            metavar=('DIRECTORY'),
+            help='decompress every ulz file found in a directory and its subdirectories, '
+                 'files already decompressed and up to date are skipped'
+        )
+
+        parser_ulz.add_argument(
+            '--ulz-data',
+            action='store_true',
+            help='with --decompress-tree, put the decompressed files in an ulz_data directory next to the ulz'
+        )
+
         parser_ulz.add_argument(
             '--output-file',
             '-f',
@@ -97,6 +163,14 @@ class CliUlz(BaseCliCommand):
             help='prompt before every removal or destructive change'
         )
 
+        parser_ulz.add_argument(
+            '--jobs',
+            '-j',
+            type=int,
+            default=1,
+            help='Number of processes to use when working on more files, or on a single big file'
+        )
+
         return subparsers
 
     def run_cmd(self, args):
@@ -108,66 +182,260 @@ class CliUlz(BaseCliCommand):
                 False,
                 args.keep
             )
-        elif args.compress:
-            self.compress_file(
-                args.compress,
-                args.output_file,
-                args.ulz_type,
-                args.level,
-                args.store_only,
-                args.parents,
-                args.like_file,
-                args.keep
-            )
+        elif args.decompress_tree:
+            self.decompress_tree(pathlib.Path(args.decompress_tree), args.ulz_data, args.jobs)
+        elif args.compress or args.compress_list:
+            if args.compress_list:
+                jobs = batch.read_job_list(pathlib.Path(args.compress_list))
+            else:
+                jobs = [batch.CompressJob(x) for x in batch.expand_inputs(args.compress)]
+
+            if args.effort is not None and args.strategy:
+                raise CliException('--effort already chooses the strategy')
+            args.strategy = args.strategy or 'greedy'
+
+            if len(jobs) == 1 and not args.compress_list:
+                self.compress_file(
+                    jobs[0].input_file,
+                    args.output_file,
+                    args.ulz_type,
+                    args.level,
+                    args.store_only,
+                    args.parents,
+                    args.like_file,
+                    args.keep,
+                    args.strategy,
+                    args.jobs,
+                    self.get_cache(args),
+                    args.effort,
+                    args.max_size
+                )
+            else:
+                self.compress_batch(jobs, args)
+
+    @staticmethod
+    def get_cache(args):
+        """
+        The compression cache selected from the command line, if any
+        """
+        if not args.cache_dir:
+            return None
+        return CompressionCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    def compress_batch(self, jobs, args):
+        """
+        Compress many files using a pool of processes, then prints a
+        report for every file
+        """
+
+        if args.output_file:
+            raise CliException('--output-file works only with a single file, use --compress-list')
+
+        outputs = {}
+        for job in jobs:
+            if not job.like_file and args.like_file:
+                job.like_file = pathlib.Path(args.like_file)
+
+            # two workers must never write the same file
+            output_file = job.output_file or job.input_file.with_suffix('.ulz')
+            if output_file.resolve() in outputs:
+                raise CliException('{} and {} are both compressed to {}'.format(
+                    outputs[output_file.resolve()], job.input_file, output_file
+                ))
+            outputs[output_file.resolve()] = job.input_file
+
+            # ask now, the workers can't prompt
+            if args.keep and output_file.resolve() != job.input_file.resolve():
+                helpers.prompt_file_exists(str(output_file.resolve()))
+
+        worker = functools.partial(
+            compress_job,
+            ulz_type=args.ulz_type,
+            level=args.level,
+            store_only=args.store_only,
+            create_parents=args.parents,
+            strategy=args.strategy,
+            cache=self.get_cache(args),
+            effort=args.effort,
+            max_size=args.max_size
+        )
+
+        results = batch.report(batch.run_jobs(worker, jobs, args.jobs))
+        errors = [x for x in results if x.error]
+        if errors:
+            raise CliException('{} files were not compressed'.format(len(errors)))
+
+    def decompress_tree(self, root_dir, create_ulz_data=False, jobs=1):
+        """
+        Decompress every ulz file found by signature under root_dir using
+        a pool of processes
+        """
+
+        if not root_dir.is_dir():
+            raise CliException('{} is not a directory'.format(root_dir))
+
+        worker = functools.partial(decompress_job, create_ulz_data=create_ulz_data)
+        results = batch.report(batch.run_jobs(worker, batch.find_ulz_files(root_dir), jobs), 'decompressed')
+        errors = [x for x in results if x.error]
+        if errors:
+            raise CliException('{} files were not decompressed'.format(len(errors)))
 
     def decompress_file(self, ulz_path, dest_filename=None, create_parents=True, create_ulz_data=False, keep=False,
-                        ulz_data_name='ulz_data'):
+                        ulz_data_name='ulz_data', update=False):
         """
-        Decompress the files from command like using UlzReader
+        Decompress the files from command like using UlzReader, with
+        update the file is skipped when the output is newer than the
+        ulz. Returns the output path, None if skipped.
         """
 
         file_path = pathlib.Path(ulz_path)
 
         try:
-            with file_path.open('rb') as ulz_file:
-                ulz_stream = io.BytesIO(ulz_file.read())
+            ulz_data = file_path.read_bytes()
         except IOError as err:
             raise CliException("Error reading the file {0}: {1}".format(ulz_path, err))
 
-        ulz_reader = UlzReader(ulz_stream)
-        data = ulz_reader.decompress()
+        ulz_reader = UlzReader(ulz_data)
 
         if dest_filename:
             file_path = pathlib.Path(dest_filename)
 
-        data_type = '.dat'
-
-        if data[0:4] == b'\x10\x00\x00\x00':
-            data_type = '.tim'
-
         if create_ulz_data:
             file_path = pathlib.Path(file_path.parent, ulz_data_name, file_path.stem)
 
-        file_path = file_path.resolve() if dest_filename else file_path.with_suffix(data_type)
+        file_path = file_path.resolve() if dest_filename else file_path.with_suffix(ulz_reader.guess_extension())
+
+        if file_path.resolve() == pathlib.Path(ulz_path).resolve():
+            raise CliException("{0} would be overwritten by its own output, choose another output file".format(
+                ulz_path))
+
+        if update and file_path.exists() and file_path.stat().st_mtime >= pathlib.Path(ulz_path).stat().st_mtime:
+            return None
 
         if create_parents or create_ulz_data:
-            file_path.parent.mkdir(0o644, True, True)
+            file_path.parent.mkdir(parents=True, exist_ok=True)
 
         if keep:
             helpers.prompt_file_exists(str(file_path.resolve()))
 
         with file_path.open('wb') as out_file:
-            out_file.write(data)
+            ulz_reader.decompress_to(out_file)
+
+        return file_path
+
+    @staticmethod
+    def same_compression(ulz_input, ulz_type, nbits, strategy, effort, max_size):
+        """
+        True when recompressing an ulz in place would give it back as
+        it is: same type and nbits, the default strategy and effort and
+        a file already within max_size
+        """
+        return (
+            ulz_type == ulz_input.u_type
+            and nbits == ulz_input.nbits
+            and strategy in (None, 'greedy')
+            and effort in (None, DEFAULT_EFFORT)
+            and (max_size is None or len(ulz_input.ulz_data) <= max_size)
+        )
+
+    level2nbits = {
+        1: 10,
+        2: 11,
+        4: 12,
+        8: 13
+    }
+
+    def get_nbits(self, ulz_type, level, like_file=None):
+        """
+        Type and nbits from the level or copied from like_file, nbits
+        is None for the level best
+        """
+        if like_file:
+            try:
+                like_file = pathlib.Path(like_file)
+                ulz_like_file = UlzReader(like_file.read_bytes())
+                return ulz_like_file.u_type, ulz_like_file.nbits
+            except IOError as err:
+                raise CliException("Error reading the file {0}: {1}".format(like_file, err))
+
+        if level == 'best':
+            return ulz_type, None
+
+        nbits = self.level2nbits.get(level, None)
+        if nbits is None:
+            raise CliException('Select the correct compression level')
+        return ulz_type, nbits
+
+    @staticmethod
+    def compress_data(input_file, source, ulz_type, nbits, store_only, strategy, max_workers, effort, max_size):
+        """
+        Returns the ulz file, trying every nbits when nbits is None or
+        fitting it in max_size
+        """
+        if nbits is None:
+            ulz_data = compress_best(source, ulz_type, store_only, strategy, max_workers, effort)[1]
+            if max_size is not None and len(ulz_data) > max_size:
+                raise UlzTooBigException('the smallest file is {} bytes'.format(len(ulz_data)))
+            return ulz_data
+
+        if max_size is not None:
+            budget_nbits, budget_effort, ulz_data = compress_budget(
+                source, ulz_type, nbits, max_size, store_only, strategy, effort, max_workers
+            )
+            if (budget_nbits, budget_effort) != (nbits, effort):
+                print('FIT  ', input_file, 'nbits {} effort {} {} bytes'.format(
+                    budget_nbits, budget_effort, len(ulz_data)))
+            return ulz_data
+
+        ulz_writer = UlzWriter(
+            source,
+            ulz_type,
+            nbits,
+            store_only,
+            strategy=strategy,
+            effort=effort,
+            max_workers=max_workers
+        )
+        ulz_writer.pack_file()
+        return ulz_writer.to_bytes()
+
+    def compress_cached(self, cache, input_file, source, ulz_type, nbits, store_only, strategy, max_workers, effort,
+                        max_size):
+        """
+        compress_data going through the CompressionCache
+        """
+        label = strategy if effort is None else 'effort{}'.format(effort)
+        if max_size is not None:
+            label += '-max{}'.format(max_size)
+        cache_key = cache.key(source, ulz_type, 'best' if nbits is None else nbits, label, store_only)
+
+        ulz_data = cache.get(cache_key)
+        if ulz_data is None:
+            ulz_data = self.compress_data(
+                input_file, source, ulz_type, nbits, store_only, strategy, max_workers, effort, max_size
+            )
+            cache.put(cache_key, ulz_data)
+
+        return ulz_data
 
     def compress_file(self, input_file, output_file=None, ulz_type=2, level=2, store_only=False, create_parents=True,
                       like_file=None,
-                      keep=False):
+                      keep=False,
+                      strategy='greedy',
+                      max_workers=1,
+                      cache=None,
+                      effort=None,
+                      max_size=None):
         """
-        Compress the files using the classes UlzWriter
+        Compress the files using the classes UlzWriter, max_workers
+        processes search the matches of big files, or try every nbits
+        with the level best. A CompressionCache is checked before
+        compressing. The effort, when given, replaces the strategy.
+        With max_size the file must fit in that many bytes, trying
+        harder if it doesn't.
         """
 
         input_file = pathlib.Path(input_file)
-        original_input_file = pathlib.Path(input_file)
 
         if input_file.stat().st_size == 0:
             raise CliException('{} is empty'.format(input_file.resolve()))
@@ -183,69 +451,104 @@ class CliUlz(BaseCliCommand):
             helpers.prompt_file_exists(output_file.resolve())
 
         if not recompress_flag and create_parents:
-            output_file.parent.mkdir(0o644, True, True)
-
-        level2nbits = {
-            1: 10,
-            2: 11,
-            4: 12,
-            8: 13
-        }
-        nbits = None
+            output_file.parent.mkdir(parents=True, exist_ok=True)
 
-        if like_file:
-            try:
-                like_file = pathlib.Path(like_file)
-                with like_file.open('rb') as ulz_file:
-                    ulz_stream = io.BytesIO(ulz_file.read())
-                    ulz_like_file = UlzReader(ulz_stream)
-                    ulz_type = ulz_like_file.u_type
-                    nbits = ulz_like_file.nbits
-
-            except IOError as err:
-                raise CliException("Error reading the file {0}: {1}".format(like_file, err))
-        else:
-            nbits = level2nbits.get(level, None)
-            if nbits is None:
-                raise CliException('Select the correct compression level')
+        ulz_type, nbits = self.get_nbits(ulz_type, level, like_file)
 
         # if input and output are the same, we are going to re-compress this file
 
-        tmp_input_dec = None
+        source = str(input_file.resolve())
+        ulz_input = None
         if recompress_flag:
-            tmp_input_dec = tempfile.NamedTemporaryFile(delete=False)
-            with input_file.open('rb') as ulz_file:
-                ulz_stream = io.BytesIO(ulz_file.read())
-                ulz_input = UlzReader(ulz_stream)
-                data = ulz_input.decompress()
-                if not data:
-                    raise CliException('No actual data into {}'.format(ulz_input))
-                tmp_input_dec.write(data)
-                tmp_input_dec.flush()
-
-            if ulz_like_file.u_type == ulz_input.u_type and ulz_like_file.level == ulz_input.level:
+            ulz_input = UlzReader(input_file.read_bytes())
+            source = ulz_input.decompress()
+            if not source:
+                raise CliException('No actual data into {}'.format(input_file))
+
+            if self.same_compression(ulz_input, ulz_type, nbits, strategy, effort, max_size):
                 print('SKIP ', input_file)
-                os.unlink(tmp_input_dec.name)
                 return None
 
-            input_file = pathlib.Path(tmp_input_dec.name)
-
         try:
-            ulz_writer = UlzWriter(
-                input_file.resolve(),
-                ulz_type,
-                nbits,
-                store_only
-            )
-            ulz_writer.pack_file()
-            ulz_writer.save(str(output_file.resolve()))
+            best = nbits is None
+            if cache:
+                if not isinstance(source, bytes):
+                    source = input_file.read_bytes()
+                ulz_data = self.compress_cached(
+                    cache, input_file, source, ulz_type, nbits, store_only, strategy, max_workers, effort, max_size
+                )
+            else:
+                ulz_data = self.compress_data(
+                    input_file, source, ulz_type, nbits, store_only, strategy, max_workers, effort, max_size
+                )
+
+            if best:
+                nbits = ulz_data[11]
+                best_level = {v: k for k, v in self.level2nbits.items()}[nbits]
+                print('BEST ', input_file, 'level {} nbits {} {} bytes'.format(best_level, nbits, len(ulz_data)))
+                if recompress_flag and self.same_compression(ulz_input, ulz_type, nbits, strategy, effort, max_size):
+                    print('SKIP ', input_file)
+                    return None
+
+            output_file.write_bytes(ulz_data)
+            return output_file
         except ValueError as exp:
             raise CliException(
-                '{} {} {} {} {}'.format(exp, input_file.resolve(), tmp_input_dec, original_input_file.resolve(),
-                                        output_file))
+                '{} {} {}'.format(exp, input_file.resolve(), output_file))
+        except UlzTooBigException as exp:
+            raise CliException('{} does not fit in {} bytes: {}'.format(input_file, max_size, exp.args[0]))
         finally:
-            if tmp_input_dec:
-                print('ULZ {} type {}:{} level {}:{}'.format(output_file.resolve(), ulz_like_file.u_type,
+            if ulz_input:
+                print('ULZ {} type {}:{} nbits {}:{}'.format(output_file.resolve(), ulz_type,
                                                              ulz_input.u_type,
-                                                             ulz_like_file.level, ulz_input.level))
-                input_file.unlink()
+                                                             nbits, ulz_input.nbits))
+
+
+def compression_level(value):
+    """
+    Type of --level, a number or best
+    """
+    return value if value == 'best' else int(value)
+
+
+def compress_job(job: batch.CompressJob, **options) -> batch.JobResult:
+    """
+    Compress a single file for the batch mode, errors are reported in
+    the result so the other files can carry on
+    """
+    result = batch.JobResult(job.input_file)
+    start = time.perf_counter()
+    try:
+        result.input_size = job.input_file.stat().st_size
+        result.output_file = CliUlz().compress_file(
+            job.input_file,
+            job.output_file,
+            like_file=job.like_file,
+            **options
+        )
+        if result.output_file:
+            result.output_size = result.output_file.stat().st_size
+    except Exception as err:
+        result.error = str(err)
+
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def decompress_job(ulz_path: pathlib.Path, create_ulz_data=False) -> batch.JobResult:
+    """
+    Decompress a single file for the tree mode, next to the ulz or in
+    the ulz_data directory, files up to date are skipped
+    """
+    result = batch.JobResult(ulz_path)
+    start = time.perf_counter()
+    try:
+        result.input_size = ulz_path.stat().st_size
+        result.output_file = CliUlz().decompress_file(ulz_path, create_ulz_data=create_ulz_data, update=True)
+        if result.output_file:
+            result.output_size = result.output_file.stat().st_size
+    except Exception as err:
+        result.error = str(err)
+
+    result.elapsed = time.perf_counter() - start
+    return result
@@ -15,32 +15,34 @@
 #  You should have received a copy of the GNU General Public License
 #  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
 
-import io
-import os
+import hashlib
 
 from ac3es.exceptions import CliException
 from ac3es.ulz import UlzReader
-from ac3es.cli import helpers
 
 
 def get_ulz_info(ulz_path):
     try:
         with open(ulz_path, 'rb') as ulz_file:
-            ulz_stream = io.BytesIO(ulz_file.read())
-            ulz = UlzReader(ulz_stream)
-            ulz.decompress()
-
-            return {
-                'path': ulz_path,
-                'type': ulz.u_type,
-                'level': ulz.level,
-                'nbits': ulz.nbits,
-                'longest_jump': ulz.longest_jump,
-                'longest_run': ulz.longest_run,
-                'ulz_size': os.path.getsize(ulz_path),
-                'file_size': ulz.uncompressed_size,
-                'md5': helpers.md5_for_file(ulz_path)
-            }
-
+            ulz_data = ulz_file.read()
     except IOError as err:
         raise CliException("Error reading the file {0}: {1}".format(ulz_path, err))
+
+    ulz = UlzReader(ulz_data)
+    content = ulz.guess_extension()[1:]
+    ulz.scan()
+
+    return {
+        'path': ulz_path,
+        'type': ulz.u_type,
+        'level': ulz.level,
+        'nbits': ulz.nbits,
+        'longest_jump': ulz.longest_jump,
+        'longest_run': ulz.longest_run,
+        'count_compressed': ulz.count_compressed,
+        'count_uncompressed': ulz.count_uncompressed,
+        'ulz_size': len(ulz_data),
+        'file_size': ulz.uncompressed_size,
+        'content': content,
+        'md5': hashlib.md5(ulz_data).hexdigest()
+    }
@@ -15,9 +15,58 @@
 #  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import collections
+import array
+import concurrent.futures
 import mmap
 import logging
+import os
+
+from ac3es.exceptions import UlzTooBigException
+
+# Cost in bits of each opcode in the ulz stream, a flag bit plus the
+# byte for the literal or the 16 bits of the jump/run pair.
+LITERAL_COST = 1 + 8
+MATCH_COST = 1 + 16
+
+# how many bytes of input between two checks of max_bits
+BUDGET_STEP = 1024
+
+# the fast parse doesn't add to its table the positions inside the
+# matches longer than this, and after 2 ** FAST_SKIP_SHIFT literals in
+# a row it searches less and less often
+FAST_MAX_INSERT = 16
+FAST_SKIP_SHIFT = 6
+
+
+class OpcodeStream:
+    """
+    The output of the sliding window, stored in the same shape of the
+    ulz file: one flag for every opcode (1 for a literal, 0 for a
+    jump/run pair), the literals and the jump/run pairs in order.
+    """
+    __slots__ = ('flags', 'literals', 'jumps', 'runs')
+
+    def __init__(self):
+        self.flags = bytearray()
+        self.literals = bytearray()
+        self.jumps = array.array('H')
+        self.runs = array.array('B')
+
+    def __len__(self):
+        return len(self.flags)
+
+    def add_literal(self, token):
+        self.flags.append(1)
+        self.literals.append(token)
+
+    def add_literals(self, tokens):
+        self.flags.extend(b'\x01' * len(tokens))
+        self.literals.extend(tokens)
+
+    def add_match(self, jmp, run):
+        self.flags.append(0)
+        self.jumps.append(jmp)
+        self.runs.append(run)
 
 
 class SlidingWindow:
@@ -40,15 +89,14 @@ class SlidingWindow:
     longest_run = 0
     longest_jump = 0
 
-    compressed_data = []
-
     def __init__(self,
-                 filename,
+                 source,
                  search_buffer_size=1024,
                  look_ahead_buffer_size=32,
                  no_compression=False,
                  min_run=3,
-                 min_match=3):
+                 min_match=3,
+                 max_bits=None):
         """
         It's important to define the search_buffer_size and
         look_ahead_buffer_size, those values creates the corrent
@@ -56,6 +104,12 @@ class SlidingWindow:
 
         The config values are get from the statistics of the ulz files
         and by reading the output generated by the decompressor.
+
+        The source is a filename or the data itself, as bytes,
+        bytearray, memoryview or mmap.
+
+        With max_bits the compression stops with UlzTooBigException as
+        soon as the opcodes can't fit in that many bits.
         """
 
         self.look_ahead_buffer_size = look_ahead_buffer_size
@@ -63,9 +117,18 @@ class SlidingWindow:
         self.no_compression = no_compression
         self.min_match = min_match
         self.min_run = min_run
-        with open(filename, 'r+b') as f:
-            self.stream = mmap.mmap(f.fileno(), 0)
+        self.opcodes = OpcodeStream()
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                self.stream = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        elif isinstance(source, (bytes, bytearray, mmap.mmap)):
+            self.stream = source
+        else:
+            # memoryview and other buffers can't be searched
+            self.stream = bytes(source)
         self.file_size = len(self.stream)
+        self.max_bits = max_bits
+        self.next_check = 0 if max_bits is not None else self.file_size
 
     def advance(self, steps=1):
         """
@@ -85,63 +148,647 @@ class SlidingWindow:
         """
         if self.no_compression:
             return self.add_uncompressed()
+        # long fills of the same byte, nothing can be longer
+        if self.lab_idx and self.stream[self.lab_idx - 1] == self.look_ahead_buffer[0]:
+            run = periodic_run(self.stream, self.lab_idx, 1, self.look_ahead_buffer_size)
+            if run == len(self.look_ahead_buffer) and run >= self.min_run:
+                return self.add_compressed(1, run)
+
         for limit in range(len(self.look_ahead_buffer), 0, -1):
             token = self.look_ahead_buffer[0:limit]
             found = self.search_buffer.find(token)
             if found >= 0:
                 run = limit
-                # We look if our search_buffer edge can compress the look_ahead_buffer
-                if self.search_buffer.endswith(token) and found == self.search_buffer.rfind(token):
-                    ring_token = collections.deque(token)
-                    extra_run = 0
-                    for char in self.look_ahead_buffer:
-                        if run + extra_run < self.look_ahead_buffer_size and ring_token[0] == char:
-                            extra_run = extra_run + 1
-                            ring_token.rotate(1)
-                        else:
-                            break
-                    if extra_run >= self.min_run:
-                        run += extra_run - len(token)
+                # the token is only at the edge of the search_buffer, the
+                # match can go on into the look_ahead_buffer
+                if found == len(self.search_buffer) - limit:
+                    run = periodic_run(self.stream, self.lab_idx, limit, self.look_ahead_buffer_size)
                 if run >= self.min_run:
-                    jmp = len(self.search_buffer) - found
-                    self.compressed_data.append({
-                        'type': 'compressed',
-                        'jmp': jmp,
-                        'run': run
-                    })
-                    logging.debug("\t".join([
-                        'C ',
-                        str(self.lab_idx),
-                        '',
-                        str(len(self.search_buffer) - found),
-                        str(run)
-                    ]))
-                    self.longest_run = max(run, self.longest_run)
-                    self.longest_jump = max(jmp, self.longest_jump)
-                    return run
+                    return self.add_compressed(len(self.search_buffer) - found, run)
         return self.add_uncompressed()
 
+    def add_compressed(self, jmp, run):
+        """
+        Add a jump/run pair for the data at the current position
+        """
+        self.opcodes.add_match(jmp, run)
+        logging.debug('C \t%d\t\t%d\t%d', self.lab_idx, jmp, run)
+        self.longest_run = max(run, self.longest_run)
+        self.longest_jump = max(jmp, self.longest_jump)
+        return run
+
     def add_uncompressed(self):
         """
         Add uncompressed byte
         """
-        self.compressed_data.append({
-            'type': 'uncompressed',
-            'token': self.look_ahead_buffer[0]
-        })
-        logging.debug(
-            "\t".join([
-                'U ',
-                str(self.lab_idx),
-                str(hex(self.look_ahead_buffer[0])),
-                '', '']))
+        return self.add_literal(self.look_ahead_buffer[0])
+
+    def add_literal(self, token):
+        """
+        Add a single byte stored as it is
+        """
+        self.opcodes.add_literal(token)
+        logging.debug('U \t%d\t%s\t\t', self.lab_idx, hex(token))
         return 1
 
+    def check_budget(self):
+        """
+        The opcodes so far plus the cheapest way to store the rest of
+        the data, when it's more than max_bits the output can't fit.
+        """
+        opcodes = self.opcodes
+        position = max(0, self.lab_idx)
+        bits = LITERAL_COST * len(opcodes.literals) + MATCH_COST * len(opcodes.jumps)
+        bits += (self.file_size - position) * min(LITERAL_COST, MATCH_COST / self.look_ahead_buffer_size)
+        if bits > self.max_bits:
+            raise UlzTooBigException('the data needs more than {} bits'.format(self.max_bits), position)
+        self.next_check = position + BUDGET_STEP
+
     def run(self):
         """
         Run the compression
         """
         self.advance()
         while self.look_ahead_buffer:
+            if self.lab_idx >= self.next_check:
+                self.check_budget()
             run = self.search()
             self.advance(run)
+
+
+def match_length(data, candidate, position, limit):
+    """
+    Count how many bytes starting from candidate are equal to the
+    ones starting from position, up to limit.
+
+    The candidate can overlap the position, the decompressor copies
+    one byte at time so the jump/run pair stays valid.
+    """
+    if data[candidate:candidate + limit] == data[position:position + limit]:
+        return limit
+
+    # binary search on the slices, comparing bytes is done in C
+    found, missed = 0, limit
+    while missed - found > 1:
+        middle = (found + missed) // 2
+        if data[candidate:candidate + middle] == data[position:position + middle]:
+            found = middle
+        else:
+            missed = middle
+    return found
+
+
+def periodic_run(data, position, period, limit):
+    """
+    How long the last period bytes before position keep repeating,
+    up to limit. It's the run of a jump/run pair with jump equal to
+    period, the pattern is repeated once and compared in one go, only
+    when the run ends early match_length finds where.
+    """
+    limit = min(limit, len(data) - position)
+    pattern = data[position - period:position]
+    repeated = pattern * (limit // period + 1)
+    if data[position:position + limit] == repeated[:limit]:
+        return limit
+    return match_length(data, position - period, position, limit)
+
+
+class HashChainMatchFinder:
+    """
+    Keeps a chain of the previous positions sharing the same first 3
+    bytes, so only the positions that can actually match are checked.
+
+    The chain is stored in a ring buffer as big as the search buffer,
+    older positions can't be used for a jump anyway.
+
+    max_chain bounds how many positions are checked, the search stops
+    too when a match is at least nice_length long, by default only
+    when it fills the look ahead buffer.
+    """
+
+    def __init__(self,
+                 data,
+                 search_buffer_size=1024,
+                 look_ahead_buffer_size=32,
+                 max_chain=128,
+                 min_match=3,
+                 nice_length=None):
+        if search_buffer_size & (search_buffer_size - 1):
+            raise ValueError('search_buffer_size must be a power of two', search_buffer_size)
+
+        self.data = data
+        self.search_buffer_size = search_buffer_size
+        self.look_ahead_buffer_size = look_ahead_buffer_size
+        self.max_chain = max_chain
+        self.min_match = max(3, min_match)
+        self.nice_length = min(nice_length or look_ahead_buffer_size, look_ahead_buffer_size)
+
+        self.window_mask = search_buffer_size - 1
+        self.head = {}
+        self.prev = [-1] * search_buffer_size
+        self.next_insert = 0
+
+    def insert_until(self, position):
+        """
+        Add to the chains every position before the given one
+        """
+        data = self.data
+        head = self.head
+        prev = self.prev
+        mask = self.window_mask
+
+        for idx in range(self.next_insert, min(position, len(data) - 2)):
+            key = data[idx:idx + 3]
+            prev[idx & mask] = head.get(key, -1)
+            head[key] = idx
+
+        self.next_insert = max(self.next_insert, position)
+
+    def longest_match(self, position):
+        """
+        Returns the best (jmp, run) for the given position, run is 0
+        when there is nothing worth to compress.
+
+        Positions must be requested in ascending order.
+        """
+        self.insert_until(position)
+
+        data = self.data
+        limit = min(self.look_ahead_buffer_size, len(data) - position)
+        if limit < self.min_match:
+            return 0, 0
+
+        prev = self.prev
+        mask = self.window_mask
+        lowest = max(0, position - self.search_buffer_size)
+
+        best_run = self.min_match - 1
+        best_jmp = 0
+        chain = self.max_chain
+        good_enough = min(limit, self.nice_length)
+        candidate = self.head.get(data[position:position + 3], -1)
+
+        while candidate >= lowest and chain > 0:
+            # cheap check on the byte that would make this match the longest one
+            if data[candidate + best_run] == data[position + best_run]:
+                run = match_length(data, candidate, position, limit)
+                if run > best_run:
+                    best_run = run
+                    best_jmp = position - candidate
+                    if run >= good_enough:
+                        break
+            candidate = prev[candidate & mask]
+            chain -= 1
+
+        if best_jmp == 0:
+            return 0, 0
+
+        return best_jmp, best_run
+
+
+class MatchTable:
+    """
+    The longest match of every position, already found, it has the
+    same longest_match of HashChainMatchFinder so the parsers can use
+    it in place of the finder.
+    """
+
+    def __init__(self, jumps, runs, look_ahead_buffer_size, min_match=3, nice_length=None):
+        self.jumps = jumps
+        self.runs = runs
+        self.look_ahead_buffer_size = look_ahead_buffer_size
+        self.min_match = min_match
+        self.nice_length = min(nice_length or look_ahead_buffer_size, look_ahead_buffer_size)
+
+    def longest_match(self, position):
+        if position >= len(self.runs):
+            return 0, 0
+        return self.jumps[position], self.runs[position]
+
+
+def build_match_tables(data, windows, max_chain=128, min_match=3, nice_length=None):
+    """
+    Finds the longest matches for more windows in a single pass, each
+    window is a (search_buffer_size, look_ahead_buffer_size) and gets
+    a MatchTable with the same matches of its own HashChainMatchFinder.
+
+    The chains are built for the biggest search buffer, while walking
+    them a window stops as soon as the jump is too long for it.
+    """
+    order = sorted(range(len(windows)), key=lambda idx: windows[idx][0])
+    sizes = [windows[idx][0] for idx in order]
+    looks = [windows[idx][1] for idx in order]
+    count = len(order)
+
+    finder = HashChainMatchFinder(data, sizes[-1], max(looks), max_chain, min_match)
+    min_match = finder.min_match
+    head = finder.head
+    prev = finder.prev
+    mask = finder.window_mask
+
+    size = len(data)
+    jumps = [array.array('H', bytes(2 * size)) for _ in order]
+    runs = [bytearray(size) for _ in order]
+
+    for position in range(size - min_match + 1):
+        if position:
+            # same as insert_until, one position at time
+            key = data[position - 1:position + 2]
+            prev[(position - 1) & mask] = head.get(key, -1)
+            head[key] = position - 1
+
+        remaining = size - position
+        limits = [min(look, remaining) for look in looks]
+        longest = max(limits)
+        good_enough = [min(limit, nice_length or limit) for limit in limits]
+        best_runs = [min_match - 1] * count
+        best_jumps = [0] * count
+        first = 0
+        chain = max_chain
+        candidate = head.get(data[position:position + 3], -1)
+
+        while candidate >= 0 and chain > 0:
+            jmp = position - candidate
+            while first < count and jmp > sizes[first]:
+                first += 1
+            if first == count:
+                break
+
+            run = -1
+            active = False
+            for idx in range(first, count):
+                best_run = best_runs[idx]
+                if best_run >= good_enough[idx]:
+                    continue
+                active = True
+                # cheap check on the byte that would make this match the longest one
+                if data[candidate + best_run] != data[position + best_run]:
+                    continue
+                if run < 0:
+                    run = match_length(data, candidate, position, longest)
+                if min(run, limits[idx]) > best_run:
+                    best_runs[idx] = min(run, limits[idx])
+                    best_jumps[idx] = jmp
+
+            if not active:
+                break
+            candidate = prev[candidate & mask]
+            chain -= 1
+
+        for idx in range(count):
+            if best_jumps[idx]:
+                jumps[idx][position] = best_jumps[idx]
+                runs[idx][position] = best_runs[idx]
+
+    tables = [None] * count
+    for idx, window_idx in enumerate(order):
+        tables[window_idx] = MatchTable(jumps[idx], runs[idx], looks[idx], min_match, nice_length)
+
+    return tables
+
+
+class SparseMatchTable:
+    """
+    The matches found only on some positions, the other ones are
+    searched when asked with a HashChainMatchFinder on the whole data.
+    The finder is filled starting from one search buffer before the
+    asked position, so it finds the same matches of a finder that went
+    through all the data.
+    """
+
+    def __init__(self, matches, finder):
+        self.matches = matches
+        self.finder = finder
+        self.look_ahead_buffer_size = finder.look_ahead_buffer_size
+        self.min_match = finder.min_match
+        self.nice_length = finder.nice_length
+
+    def longest_match(self, position):
+        found = self.matches.get(position)
+        if found is None:
+            finder = self.finder
+            finder.next_insert = max(finder.next_insert, position - finder.search_buffer_size)
+            found = finder.longest_match(position)
+        return found
+
+
+def find_block_matches(block, start, end, search_buffer_size, look_ahead_buffer_size, max_chain=128,
+                       min_match=3, nice_length=None, strategy='optimal'):
+    """
+    The longest matches from start to end of the block, a piece of the
+    data beginning one search buffer before start, so the chains are
+    the same they would be on the whole data.
+
+    optimal needs all the positions, for greedy and lazy only the ones
+    their parse would visit starting from the beginning of the block
+    are searched. Returns a dict position: (jmp, run).
+    """
+    finder = HashChainMatchFinder(block, search_buffer_size, look_ahead_buffer_size, max_chain, min_match,
+                                  nice_length)
+    matches = {}
+    if strategy == 'optimal':
+        for position in range(start, end):
+            matches[position - start] = finder.longest_match(position)
+        return matches
+
+    # the same steps of parse_greedy and parse_lazy
+    position = start
+    jmp, run = matches[0] = finder.longest_match(position)
+    while position < end:
+        if strategy == 'lazy' and run and run < finder.nice_length and position + 1 < end:
+            next_jmp, next_run = matches[position + 1 - start] = finder.longest_match(position + 1)
+            if next_run > run:
+                position += 1
+                jmp, run = next_jmp, next_run
+                continue
+
+        position += run or 1
+        if position < end:
+            jmp, run = matches[position - start] = finder.longest_match(position)
+
+    return matches
+
+
+def build_block_match_table(data, search_buffer_size, look_ahead_buffer_size, max_chain=128, min_match=3,
+                            nice_length=None, block_size=0x40000, max_workers=1, strategy='optimal'):
+    """
+    Same matches of a HashChainMatchFinder, found splitting the data in
+    blocks searched by a pool of processes. Each block overlaps the
+    previous one by a search buffer, the oldest position a jump can
+    reach, and by a look ahead buffer after its end for the last runs.
+
+    Where a parse crosses into the next block on a position that block
+    didn't search, the SparseMatchTable searches it on the spot.
+    """
+    size = len(data)
+    blocks = []
+    for start in range(0, size, block_size):
+        end = min(start + block_size, size)
+        lower = max(0, start - search_buffer_size)
+        blocks.append((data[lower:end + look_ahead_buffer_size], start - lower, end - lower))
+
+    options = (search_buffer_size, look_ahead_buffer_size, max_chain, min_match, nice_length, strategy)
+    with concurrent.futures.ProcessPoolExecutor(min(max_workers, len(blocks))) as executor:
+        futures = [executor.submit(find_block_matches, *block, *options) for block in blocks]
+        results = [future.result() for future in futures]
+
+    matches = {}
+    for start, block_matches in zip(range(0, size, block_size), results):
+        matches.update((start + position, found) for position, found in block_matches.items())
+
+    finder = HashChainMatchFinder(data, search_buffer_size, look_ahead_buffer_size, max_chain, min_match,
+                                  nice_length)
+    return SparseMatchTable(matches, finder)
+
+
+class HashChainWindow(SlidingWindow):
+    """
+    Same jump/run constraints of SlidingWindow, but the matches are
+    found with a HashChainMatchFinder instead of looking for every
+    prefix of the look ahead buffer.
+
+    The strategy decides how the matches are used: greedy takes
+    always the longest match, lazy checks first if the next position
+    has a longer one, optimal looks for the smallest output. fast is
+    a greedy with a single candidate for every position, it doesn't
+    use the finder nor the match tables.
+
+    With more than one worker, data longer than a block is searched in
+    parallel by build_block_match_table, the parse stays sequential.
+    """
+
+    strategies = ('fast', 'greedy', 'lazy', 'optimal')
+
+    def __init__(self,
+                 source,
+                 search_buffer_size=1024,
+                 look_ahead_buffer_size=32,
+                 no_compression=False,
+                 min_run=3,
+                 min_match=3,
+                 max_chain=128,
+                 strategy='greedy',
+                 match_table=None,
+                 nice_length=None,
+                 max_workers=1,
+                 block_size=0x40000,
+                 max_bits=None):
+        super().__init__(
+            source,
+            search_buffer_size,
+            look_ahead_buffer_size,
+            no_compression,
+            min_run,
+            min_match,
+            max_bits
+        )
+
+        if strategy not in self.strategies:
+            raise ValueError('strategy not valid', strategy)
+
+        self.strategy = strategy
+        self.data = bytes(self.stream)
+        if strategy == 'fast':
+            match_table = None
+        elif not match_table and not no_compression and max_workers > 1 and self.file_size > block_size:
+            match_table = build_block_match_table(
+                self.data,
+                search_buffer_size,
+                look_ahead_buffer_size,
+                max_chain,
+                max(min_run, min_match),
+                nice_length,
+                block_size,
+                max_workers,
+                strategy
+            )
+
+        # a MatchTable from build_match_tables skips the search
+        self.match_finder = match_table or HashChainMatchFinder(
+            self.data,
+            search_buffer_size,
+            look_ahead_buffer_size,
+            max_chain,
+            max(min_run, min_match),
+            nice_length
+        )
+
+    def run(self):
+        """
+        Run the compression
+        """
+        if self.no_compression:
+            self.lab_idx = 0
+            while self.lab_idx < self.file_size:
+                self.lab_idx += self.add_literal(self.data[self.lab_idx])
+        elif self.strategy == 'optimal':
+            self.parse_optimal()
+        elif self.strategy == 'lazy':
+            self.parse_lazy()
+        elif self.strategy == 'fast':
+            self.parse_fast()
+        else:
+            self.parse_greedy()
+
+    def parse_greedy(self):
+        """
+        Take the longest match at every position
+        """
+        self.lab_idx = 0
+        while self.lab_idx < self.file_size:
+            if self.lab_idx >= self.next_check:
+                self.check_budget()
+            jmp, run = self.match_finder.longest_match(self.lab_idx)
+            if run:
+                self.lab_idx += self.add_compressed(jmp, run)
+            else:
+                self.lab_idx += self.add_literal(self.data[self.lab_idx])
+
+    def parse_fast(self):
+        """
+        Greedy with the cheapest search, like LZ4: a table keeps only
+        the last position of every 3 bytes, so there is a single
+        candidate to check. The positions inside the long matches are
+        not added to the table and in a long run of literals the search
+        skips ahead more and more.
+        """
+        data = self.data
+        size = self.file_size
+        search_buffer_size = self.search_buffer_size
+        look_ahead = self.look_ahead_buffer_size
+        min_run = self.match_finder.min_match
+        head = {}
+        misses = 0
+        position = 0
+        while position < size:
+            if position >= self.next_check:
+                self.lab_idx = position
+                self.check_budget()
+
+            key = data[position:position + 3]
+            candidate = head.get(key, -1)
+            head[key] = position
+            run = 0
+            if candidate >= 0 and position - candidate <= search_buffer_size:
+                run = match_length(data, candidate, position, min(look_ahead, size - position))
+
+            if run >= min_run:
+                self.lab_idx = position
+                self.add_compressed(position - candidate, run)
+                if run <= FAST_MAX_INSERT:
+                    for idx in range(position + 1, position + run):
+                        head[data[idx:idx + 3]] = idx
+                position += run
+                misses = 0
+            else:
+                misses += 1
+                step = 1 + (misses >> FAST_SKIP_SHIFT)
+                self.opcodes.add_literals(data[position:position + step])
+                position += step
+
+        self.lab_idx = min(position, size)
+
+    def parse_lazy(self):
+        """
+        Before taking a match look at the next position, when it has a
+        longer match store a literal and use that one instead, like the
+        lazy evaluation of zlib. Matches nice_length long are taken
+        right away.
+        """
+        finder = self.match_finder
+        self.lab_idx = 0
+        jmp, run = finder.longest_match(self.lab_idx)
+        while self.lab_idx < self.file_size:
+            if self.lab_idx >= self.next_check:
+                self.check_budget()
+            if run and run < finder.nice_length:
+                next_jmp, next_run = finder.longest_match(self.lab_idx + 1)
+                if next_run > run:
+                    self.lab_idx += self.add_literal(self.data[self.lab_idx])
+                    jmp, run = next_jmp, next_run
+                    continue
+
+            if run:
+                self.lab_idx += self.add_compressed(jmp, run)
+            else:
+                self.lab_idx += self.add_literal(self.data[self.lab_idx])
+            jmp, run = finder.longest_match(self.lab_idx)
+
+    def find_matches_in_budget(self, jumps, runs):
+        """
+        The search of parse_optimal, keeping also the cheapest cost to
+        reach every position with the matches found so far. Any parse
+        goes past the current position landing within a look ahead
+        buffer, the cheapest of those plus the cheapest way to store
+        the rest of the data is the smallest possible output.
+        """
+        size = self.file_size
+        min_run = self.match_finder.min_match
+        look_ahead = self.look_ahead_buffer_size
+        rate = min(LITERAL_COST, MATCH_COST / look_ahead)
+        unreachable = LITERAL_COST * (size + 1) + 1
+        reach = [0] + [unreachable] * (size + look_ahead)
+
+        self.lab_idx = 0
+        self.check_budget()
+        for position in range(size):
+            jumps[position], runs[position] = self.match_finder.longest_match(position)
+            here = reach[position]
+            if here + LITERAL_COST < reach[position + 1]:
+                reach[position + 1] = here + LITERAL_COST
+
+            longest = runs[position]
+            if longest:
+                cost = here + MATCH_COST
+                lower, upper = position + min_run, position + longest + 1
+                reach[lower:upper] = [x if x < cost else cost for x in reach[lower:upper]]
+
+            if position >= self.next_check:
+                ahead = reach[position + 1:position + look_ahead + 1]
+                bits = min(x + (size - position - 1 - idx) * rate for idx, x in enumerate(ahead))
+                if bits > self.max_bits:
+                    raise UlzTooBigException('the data needs more than {} bits'.format(self.max_bits), position)
+                self.next_check = position + BUDGET_STEP
+
+    def parse_optimal(self):
+        """
+        Minimum size parse, it gets the longest match of every
+        position and then finds backwards the cheapest way to reach
+        the end of the file.
+
+        The cost of a jump/run pair doesn't depend on its values, so
+        every run shorter than the longest one is a candidate too.
+        """
+        size = self.file_size
+        jumps = array.array('H', bytes(2 * size))
+        runs = bytearray(size)
+        if self.max_bits is not None:
+            self.find_matches_in_budget(jumps, runs)
+        else:
+            for position in range(size):
+                jumps[position], runs[position] = self.match_finder.longest_match(position)
+
+        min_run = self.match_finder.min_match
+        cost = [0] * (size + 1)
+        choice = bytearray(size)
+        for position in range(size - 1, -1, -1):
+            best = cost[position + 1] + LITERAL_COST
+            longest = runs[position]
+            if longest:
+                candidates = cost[position + min_run:position + longest + 1]
+                cheapest = min(candidates)
+                if cheapest + MATCH_COST < best:
+                    best = cheapest + MATCH_COST
+                    choice[position] = candidates.index(cheapest) + min_run
+            cost[position] = best
+
+        if self.max_bits is not None and cost[0] > self.max_bits:
+            raise UlzTooBigException('the data needs more than {} bits'.format(self.max_bits), cost[0])
+
+        self.lab_idx = 0
+        while self.lab_idx < size:
+            run = choice[self.lab_idx]
+            if run:
+                self.lab_idx += self.add_compressed(jumps[self.lab_idx], run)
+            else:
+                self.lab_idx += self.add_literal(self.data[self.lab_idx])
@@ -16,38 +16,43 @@
 #  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import io
-import sys
 from ac3es.cli import helpers
+from ac3es.tim import TimReader
 
 
 class UlzReader:
     """
     Read compressed Ulz files made for Ace Combat 3 version 0 and 2
     """
+    signature = b'Ulz\x1A'
 
-    def __init__(self, ulz_stream):
-        """Accepts a strem for read the Ulz data, this function reads
-        the header and initialize the class"""
+    def __init__(self, ulz_data):
+        """Accepts the Ulz data as any object supporting the buffer
+        protocol (bytes, bytearray, mmap or a memoryview slice of a
+        bigger file), the data is read in place without copies.
 
-        self.ulz_stream = ulz_stream
-        self.ulz_stream.seek(0)
+        A binary stream without the buffer protocol, like BytesIO, is
+        still accepted, in that case its content is read once. An mmap
+        has read too, but it's used in place and its position is left
+        alone.
 
-        self.signature = self.ulz_stream.read(4)
-        if self.signature != b'Ulz\x1A':
+        This function reads the header and initialize the class"""
+
+        try:
+            self.ulz_data = memoryview(ulz_data).cast('B')
+        except TypeError:
+            ulz_data.seek(0)
+            self.ulz_data = memoryview(ulz_data.read()).cast('B')
+
+        if self.ulz_data[0:4] != self.signature or len(self.ulz_data) < 16:
             raise Exception('The file is not an ulz archive')
 
-        raw_uncompressed_size = self.ulz_stream.read(3)
-        self.u_type = self.ulz_stream.read(1)
-        if self.u_type != b'\x00' and self.u_type != b'\x02':
+        self.u_type = self.ulz_data[7]
+        if self.u_type != 0 and self.u_type != 2:
             raise Exception('Format "{}" not supported'.format(self.u_type))
-        self.u_type = helpers.b2uint(self.u_type)
-
-        self.uncompressed_size = helpers.b2uint(raw_uncompressed_size)
 
-        raw_uncompressed_offset = self.ulz_stream.read(3)
-        self.nbits = self.ulz_stream.read(1)
-        self.nbits = helpers.b2uint(self.nbits)
+        self.uncompressed_size = helpers.b2uint(self.ulz_data[4:7])
+        self.nbits = self.ulz_data[11]
 
         levels = {
             10: 1,
@@ -56,129 +61,186 @@ class UlzReader:
             13: 8
         }
 
-        self.level = levels.get(self.nbits)
+        if self.nbits not in levels:
+            raise Exception('nbits "{}" not supported'.format(self.nbits))
 
-        self.uncompressed_offset = helpers.b2uint(raw_uncompressed_offset)
-        raw_compressed_offset = self.ulz_stream.read(4)
-        self.compressed_offset = helpers.b2uint(raw_compressed_offset[:-1])
+        self.level = levels[self.nbits]
+
+        self.uncompressed_offset = helpers.b2uint(self.ulz_data[8:11])
+        self.compressed_offset = helpers.b2uint(self.ulz_data[12:15])
 
         self.mask_run = ((1 << self.nbits) + 0xffff) & 0xFFFF
 
-        self.flags = []
-        self.flag_start = self.ulz_stream.tell()
+        self.flag_start = 16
 
         self.longest_jump = 0
         self.longest_run = 0
         self.count_compressed = 0
         self.count_uncompressed = 0
 
-    def get_flags(self):
-        """Reads the flags form the ulz stream at 32bit at time, it
-        returns the raw data"""
-
-        curr = self.ulz_stream.tell()
-        self.ulz_stream.seek(self.flag_start, 0)
-        flags = self.ulz_stream.read(4)
-
-        self.flag_start = self.flag_start + 4
-        self.ulz_stream.seek(curr, 0)
-
-        # from bytes to boolean, we invert the bits too
-        num_flags = int.from_bytes(flags, byteorder='little')
-        bool_flags = []
-        for x in range(32):
-            bool_flags.insert(
-                0,
-                False if num_flags & (1 << x) else True
-            )
-        bool_flags.reverse()
-        return bool_flags
-
-    def is_compressed_flag(self):
-        """Flags has to be read in different ways regarding the Ulz
-        version, this function makes the right decisions for ulzv0 and
-        ulzV2. Returns True if we have to decompress the data."""
+    def __enter__(self):
+        return self
 
-        try:
-            is_comp = self.flags.pop()
-        except IndexError:
-            ba = self.get_flags()
-            if self.u_type == 0:
-                # The original decompressor checks for the sign in
-                # the registry to figure out if we have to decompress
-                # the data. It ignores the last bit because the process ends
-                # when the register r11 (used for the flags) is empty.
-                self.flags = ba[1:]
-            else:
-                # Version 2 is much simpler, uses all the bits in the
-                # registry for decompression.
-                self.flags = ba
-
-            is_comp = self.flags.pop()
-
-        return is_comp
-
-    def decompress(self):
-        """Decompress the ulz stream, returns an io.BytesIO instance"""
-
-        c_seek = self.compressed_offset
-        u_seek = self.uncompressed_offset
-        decompressed_data = b''
-
-        with io.BytesIO() as out_file:
-            while out_file.tell() < self.uncompressed_size:
-
-                if self.is_compressed_flag():
-                    self.count_compressed += 1
-                    self.ulz_stream.seek(c_seek, 0)
-                    data = helpers.b2uint(self.ulz_stream.read(2))
-                    c_seek = self.ulz_stream.tell()
-
-                    jump = data & self.mask_run
-                    jump += 1
-                    run = data >> self.nbits
-                    run += 3
-
-                    self.longest_jump = max(jump, self.longest_jump)
-                    self.longest_run = max(run, self.longest_run)
-
-                    out_file.seek(0, 2)
-                    curr_position = out_file.tell()
-                    tmp_buff = b''
-
-                    circular_index = 0
-                    for r in range(run):
-                        position = curr_position - jump + r
-                        out_file.seek(position)
-                        found_data = out_file.read(1)
-
-                        if found_data == b'':
-                            try:
-                                found_data = tmp_buff[circular_index]
-                                circular_index += 1
-                            except IndexError:
-                                circular_index = 0
-                                found_data = tmp_buff[circular_index]
-
-                        if isinstance(found_data, int):
-                            found_data = found_data.to_bytes(1, 'little')
-
-                        if out_file.tell() >= self.uncompressed_size:
-                            tmp_buff = b''
-                            sys.exit(-1)
-                            break
-
-                        tmp_buff += found_data
-
-                    out_file.seek(0, 2)
-                    out_file.write(tmp_buff)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self):
+        """Release the view on the data, an mmap can't be closed while
+        a reader is still using it"""
+
+        self.ulz_data.release()
+
+    def flag_bits(self):
+        """Number of flags stored in every 32 bit word.
+
+        The original decompressor for ulz0 checks for the sign in the
+        register to figure out if we have to decompress the data. It
+        ignores the last bit because the process ends when the register
+        r11 (used for the flags) is empty.
+
+        Version 2 is much simpler, uses all the bits in the register
+        for decompression."""
+
+        return 31 if self.u_type == 0 else 32
+
+    def max_opcode_size(self):
+        """Most bytes a single flag word can produce, a run of literals
+        or the longest jump/run pair"""
+
+        return max(32, (0xFFFF >> self.nbits) + 3)
+
+    def guess_extension(self):
+        """Decompress only the first bytes to tell if the content is a
+        TIM, returns the extension to use for the decompressed file"""
+
+        if self.decompress(limit=4) == TimReader.signature:
+            return '.tim'
+        return '.dat'
+
+    def decompress(self, limit=None):
+        """Decompress the ulz stream, returns the data as bytes.
+
+        With a limit the decompression stops as soon as that many
+        bytes are ready, only those are returned."""
+
+        size = self.uncompressed_size
+        if limit is not None:
+            size = min(size, limit)
+
+        out_data = bytearray(size)
+        self.walk_opcodes(size, out_data)
+        return bytes(out_data)
+
+    def scan(self):
+        """Reads all the flags and the jump/run pairs to collect the
+        statistics, without rebuilding the data"""
+
+        self.walk_opcodes(self.uncompressed_size, None)
+
+    def decompress_to(self, stream, block_size=0x10000):
+        """Decompress the ulz data into a writable binary stream, in
+        memory are kept only the last jump window and a block of
+        output. Returns the number of bytes written"""
+
+        out_data = bytearray((1 << self.nbits) + block_size + self.max_opcode_size())
+        self.walk_opcodes(self.uncompressed_size, out_data, stream)
+        return self.uncompressed_size
+
+    def walk_opcodes(self, size, out_data, stream=None):
+        """Follows the opcodes until size bytes are covered, the data
+        is written in out_data only when it's given.
+
+        With a stream out_data is a buffer smaller than size, when it's
+        almost full everything but the last jump window is written to
+        the stream and the window is moved to the beginning."""
+
+        self.longest_jump = 0
+        self.longest_run = 0
+        self.count_compressed = 0
+        self.count_uncompressed = 0
+
+        raw_data = self.ulz_data
+        literals = raw_data[self.uncompressed_offset:self.compressed_offset]
+        tokens = raw_data[self.compressed_offset:]
+
+        # out_data[0] is the byte at position base of the decompressed data
+        base = 0
+        window = 1 << self.nbits
+        if stream is not None:
+            flush_limit = len(out_data) - self.max_opcode_size()
+
+        position = 0
+        literal_idx = 0
+        token_idx = 0
+
+        # the flags are consumed from the most significant bit, a set
+        # bit is a literal and a clear bit a jump/run pair
+        flag_idx = self.flag_start
+        word_bits = self.flag_bits()
+        register = 0
+        bits_left = 0
+
+        while position < size:
+            if stream is not None and position - base > flush_limit:
+                keep_from = position - base - window
+                with memoryview(out_data) as out_view:
+                    stream.write(out_view[:keep_from])
+                out_data[:window] = out_data[keep_from:keep_from + window]
+                base += keep_from
+
+            if not bits_left:
+                register = int.from_bytes(raw_data[flag_idx:flag_idx + 4], byteorder='little')
+                flag_idx += 4
+                bits_left = word_bits
+
+            if register & 0x80000000:
+                # copy all the literals flagged in a row at once, they
+                # are as many as the leading ones in the register
+                count = 32 - (register ^ 0xFFFFFFFF).bit_length()
+                count = min(count, bits_left, size - position)
+                if literal_idx + count > len(literals):
+                    raise Exception('Not enough literals for {} bytes at {}'.format(count, position))
+
+                if out_data is not None:
+                    out_idx = position - base
+                    out_data[out_idx:out_idx + count] = literals[literal_idx:literal_idx + count]
+                literal_idx += count
+                position += count
+                self.count_uncompressed += count
+                register = (register << count) & 0xFFFFFFFF
+                bits_left -= count
+                continue
+
+            register = (register << 1) & 0xFFFFFFFF
+            bits_left -= 1
+
+            self.count_compressed += 1
+            data = tokens[token_idx] | tokens[token_idx + 1] << 8
+            token_idx += 2
+
+            jump = (data & self.mask_run) + 1
+            run = (data >> self.nbits) + 3
+
+            self.longest_jump = max(jump, self.longest_jump)
+            self.longest_run = max(run, self.longest_run)
+
+            start = position - jump
+            if start < 0:
+                raise Exception('Jump {} before the start of the data at {}'.format(jump, position))
+
+            run = min(run, size - position)
+            if out_data is not None:
+                out_idx = position - base
+                start -= base
+                if jump >= run:
+                    out_data[out_idx:out_idx + run] = out_data[start:start + run]
                 else:
-                    self.count_uncompressed += 1
-                    self.ulz_stream.seek(u_seek, 0)
-                    udata = self.ulz_stream.read(1)
-                    u_seek = self.ulz_stream.tell()
-                    out_file.write(udata)
-
-            self.ulz_stream.close()
-            decompressed_data = out_file.getvalue()
-        return decompressed_data
+                    # the run overlaps the data we are writing, the
+                    # last jump bytes repeat until the end of the run
+                    pattern = out_data[start:out_idx]
+                    out_data[out_idx:out_idx + run] = (pattern * (run // jump + 1))[:run]
+            position += run
+
+        if stream is not None:
+            with memoryview(out_data) as out_view:
+                stream.write(out_view[:position - base])
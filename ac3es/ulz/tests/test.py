@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of AC3ES Tools.
+#
+#  AC3ES Tools is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  AC3ES Tools is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import contextlib
+import functools
+import io
+import mmap
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+from ac3es.cli.helpers import md5_for_file
+from ac3es.ulz import UlzReader, UlzWriter, CliUlz, compress_bytes, compress_best, helpers, batch
+from ac3es.ulz.lz77 import HashChainMatchFinder, HashChainWindow, SparseMatchTable, build_match_tables, \
+    periodic_run
+from ac3es.ulz.cache import CompressionCache
+from ac3es.ulz.writer import DEFAULT_EFFORT, compress_budget
+from ac3es.exceptions import CliException, UlzTooBigException
+from ac3es.ulz.cli import compress_job, decompress_job
+
+
+class TestUlz(unittest.TestCase):
+    def setUp(self) -> None:
+        self.maxDiff = None
+        self.assets_dir = pathlib.Path(__file__).parent.joinpath('assets')
+        self.test_tim = self.assets_dir.joinpath('lulu.tim')
+        self.test_ulz = self.assets_dir.joinpath('occhietto_big.ulz')
+        self.test_ulz_data = self.assets_dir.joinpath('occhietto_big.tim')
+
+    def compress(self, source: pathlib.Path, ulz_type, nbits, **kwargs) -> bytes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dest = pathlib.Path(tmp_dir).joinpath('test.ulz')
+            ulz_writer = UlzWriter(str(source), ulz_type, nbits, **kwargs)
+            ulz_writer.pack_file()
+            ulz_writer.save(str(dest))
+            return dest.read_bytes()
+
+    def decompress(self, data: bytes) -> bytes:
+        return UlzReader(data).decompress()
+
+    def test_decompress(self):
+        self.assertEqual(
+            self.decompress(self.test_ulz.read_bytes()),
+            self.test_ulz_data.read_bytes()
+        )
+
+    def test_decompress_limit(self):
+        expected = self.test_ulz_data.read_bytes()
+        ulz_reader = UlzReader(self.test_ulz.read_bytes())
+        for limit in (0, 1, 4, 1000, 33333, len(expected), len(expected) + 1):
+            self.assertEqual(ulz_reader.decompress(limit=limit), expected[:limit], limit)
+        self.assertEqual(ulz_reader.guess_extension(), '.tim')
+        self.assertEqual(UlzReader(compress_bytes(b'\x00' * 100, 2, 10)).guess_extension(), '.dat')
+
+        # a broken header must not ask for a huge window
+        broken = bytearray(self.test_ulz.read_bytes())
+        broken[11] = 60
+        with self.assertRaises(Exception):
+            UlzReader(broken)
+
+    def test_decompress_to(self):
+        expected = self.test_ulz_data.read_bytes()
+        ulz_reader = UlzReader(self.test_ulz.read_bytes())
+        for block_size in (1, 1000, 0x10000):
+            with io.BytesIO() as out_stream:
+                self.assertEqual(ulz_reader.decompress_to(out_stream, block_size), len(expected))
+                self.assertEqual(out_stream.getvalue(), expected, block_size)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ulz_path = pathlib.Path(tmp_dir).joinpath('test.ulz')
+            shutil.copy(self.test_ulz, ulz_path)
+            CliUlz().decompress_file(ulz_path)
+            self.assertEqual(ulz_path.with_suffix('.tim').read_bytes(), expected)
+
+    def test_scan(self):
+        ulz_reader = UlzReader(self.test_ulz.read_bytes())
+        ulz_reader.decompress()
+        stats = (ulz_reader.longest_jump, ulz_reader.longest_run,
+                 ulz_reader.count_compressed, ulz_reader.count_uncompressed)
+        ulz_reader.scan()
+        self.assertEqual(
+            (ulz_reader.longest_jump, ulz_reader.longest_run,
+             ulz_reader.count_compressed, ulz_reader.count_uncompressed),
+            stats
+        )
+
+        info = helpers.get_ulz_info(str(self.test_ulz))
+        self.assertEqual((info['longest_jump'], info['longest_run']), stats[:2])
+        self.assertEqual(info['content'], 'tim')
+        self.assertEqual(info['md5'], md5_for_file(self.test_ulz))
+
+    def test_decompress_buffers(self):
+        expected = self.test_ulz_data.read_bytes()
+        ulz_data = self.test_ulz.read_bytes()
+
+        ulz_stream = io.BytesIO(ulz_data)
+        self.assertEqual(UlzReader(ulz_stream).decompress(), expected)
+        self.assertFalse(ulz_stream.closed)
+
+        # an ulz inside a bigger file, read in place
+        container = b'\xff' * 100 + ulz_data + b'\xff' * 100
+        self.assertEqual(UlzReader(memoryview(container)[100:100 + len(ulz_data)]).decompress(), expected)
+
+        with self.test_ulz.open('rb') as ulz_file:
+            with mmap.mmap(ulz_file.fileno(), 0, access=mmap.ACCESS_READ) as ulz_map:
+                ulz_map.seek(10)
+                with UlzReader(ulz_map) as ulz_reader:
+                    self.assertIs(ulz_reader.ulz_data.obj, ulz_map)
+                    self.assertEqual(ulz_reader.decompress(), expected)
+                self.assertEqual(ulz_map.tell(), 10)
+
+    def test_engines(self):
+        original = self.test_tim.read_bytes()
+        for ulz_type in (0, 2):
+            for nbits, (search_buffer, look_ahead_buffer) in UlzWriter.conf.items():
+                for engine in UlzWriter.engines.keys():
+                    ulz_reader = UlzReader(self.compress(self.test_tim, ulz_type, nbits, engine=engine))
+                    self.assertEqual(ulz_reader.decompress(), original, (ulz_type, nbits, engine))
+                    self.assertLessEqual(ulz_reader.longest_jump, search_buffer)
+                    self.assertLessEqual(ulz_reader.longest_run, look_ahead_buffer)
+
+    def test_strategies(self):
+        original = self.test_ulz_data.read_bytes()
+        for nbits in UlzWriter.conf.keys():
+            greedy = self.compress(self.test_ulz_data, 2, nbits)
+            lazy = self.compress(self.test_ulz_data, 2, nbits, strategy='lazy')
+            optimal = self.compress(self.test_ulz_data, 2, nbits, strategy='optimal')
+            self.assertEqual(self.decompress(lazy), original, nbits)
+            self.assertEqual(self.decompress(optimal), original, nbits)
+            self.assertLessEqual(len(optimal), len(greedy), nbits)
+
+    def test_opcodes_per_instance(self):
+        first = UlzWriter(str(self.test_tim), 2, 10)
+        second = UlzWriter(str(self.test_tim), 2, 10)
+        self.assertIsNot(first.sliding_window.opcodes, second.sliding_window.opcodes)
+        self.assertEqual(len(first.sliding_window.opcodes), len(second.sliding_window.opcodes))
+        self.assertEqual(
+            len(first.sliding_window.opcodes.literals) + sum(first.sliding_window.opcodes.runs),
+            self.test_tim.stat().st_size
+        )
+
+    def test_compress_bytes(self):
+        original = self.test_tim.read_bytes()
+        expected = self.compress(self.test_tim, 0, 11)
+        self.assertEqual(compress_bytes(original, 0, 11), expected)
+        self.assertEqual(compress_bytes(bytearray(original), 0, 11), expected)
+        self.assertEqual(compress_bytes(memoryview(original), 0, 11), expected)
+        with self.test_tim.open('rb') as tim_file:
+            with mmap.mmap(tim_file.fileno(), 0, access=mmap.ACCESS_READ) as tim_map:
+                self.assertEqual(compress_bytes(tim_map, 0, 11), expected)
+
+    def test_recompress(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ulz_path = pathlib.Path(tmp_dir).joinpath('test.ulz')
+            shutil.copy(self.test_ulz, ulz_path)
+            CliUlz().compress_file(ulz_path, ulz_path, ulz_type=2, level=1)
+            ulz_reader = UlzReader(ulz_path.read_bytes())
+            self.assertEqual((ulz_reader.u_type, ulz_reader.nbits), (2, 10))
+            self.assertEqual(ulz_reader.decompress(), self.test_ulz_data.read_bytes())
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertIsNone(CliUlz().compress_file(ulz_path, ulz_path, ulz_type=2, level=1))
+
+                # a budget the file doesn't meet or another effort compress it again
+                max_size = ulz_path.stat().st_size - 100
+                self.assertEqual(CliUlz().compress_file(ulz_path, ulz_path, 2, 1, max_size=max_size), ulz_path)
+                self.assertLessEqual(ulz_path.stat().st_size, max_size)
+                self.assertIsNone(CliUlz().compress_file(ulz_path, ulz_path, 2, 1, max_size=max_size))
+                self.assertEqual(CliUlz().compress_file(ulz_path, ulz_path, 2, 1, effort=0), ulz_path)
+            self.assertEqual(UlzReader(ulz_path.read_bytes()).decompress(), self.test_ulz_data.read_bytes())
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = pathlib.Path(tmp_dir)
+            for name in ('a.tim', 'b.tim'):
+                shutil.copy(self.test_tim, tmp_path.joinpath(name))
+            tmp_path.joinpath('list.txt').write_text("a.tim\tout/a.ulz\nb.tim\n")
+
+            self.assertEqual(
+                batch.expand_inputs([str(tmp_path.joinpath('*.tim'))]),
+                [tmp_path.joinpath('a.tim'), tmp_path.joinpath('b.tim')]
+            )
+
+            jobs = batch.read_job_list(tmp_path.joinpath('list.txt'))
+            self.assertEqual(jobs[0].output_file, tmp_path.joinpath('out', 'a.ulz'))
+            self.assertIsNone(jobs[1].output_file)
+
+            worker = functools.partial(compress_job, ulz_type=2, level=1, create_parents=True)
+            results = list(batch.run_jobs(worker, jobs, 2))
+            self.assertEqual([x.error for x in results], [None, None])
+            self.assertEqual([x.output_file for x in results], [jobs[0].output_file, tmp_path.joinpath('b.ulz')])
+            for result in results:
+                self.assertEqual(self.decompress(result.output_file.read_bytes()), self.test_tim.read_bytes())
+
+            # the ulz from the previous run are not compressed again
+            self.assertEqual(
+                batch.expand_inputs([str(tmp_path)]),
+                [tmp_path.joinpath('a.tim'), tmp_path.joinpath('b.tim'), tmp_path.joinpath('list.txt')]
+            )
+
+            args = argparse.Namespace(output_file=None, like_file=None, keep=False)
+            jobs = [batch.CompressJob(tmp_path.joinpath('b.tim')), batch.CompressJob(tmp_path.joinpath('b.ulz'))]
+            with self.assertRaises(CliException):
+                CliUlz().compress_batch(jobs, args)
+
+    def test_decompress_tree(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = pathlib.Path(tmp_dir)
+            tmp_path.joinpath('sub').mkdir()
+            shutil.copy(self.test_ulz, tmp_path.joinpath('a.ulz'))
+            shutil.copy(self.test_ulz, tmp_path.joinpath('sub', 'b.bin'))
+            shutil.copy(self.test_tim, tmp_path.joinpath('sub', 'c.tim'))
+
+            ulz_files = batch.find_ulz_files(tmp_path)
+            self.assertEqual(ulz_files, [tmp_path.joinpath('a.ulz'), tmp_path.joinpath('sub', 'b.bin')])
+
+            results = list(batch.run_jobs(decompress_job, ulz_files, 2))
+            self.assertEqual([x.error for x in results], [None, None])
+            self.assertEqual(
+                [x.output_file for x in results],
+                [tmp_path.joinpath('a.tim'), tmp_path.joinpath('sub', 'b.tim')]
+            )
+            for result in results:
+                self.assertEqual(result.output_file.read_bytes(), self.test_ulz_data.read_bytes())
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                results = batch.report(batch.run_jobs(decompress_job, ulz_files), 'decompressed')
+            self.assertEqual([x.output_file for x in results], [None, None])
+            self.assertIn('Decompressed 0 files, 2 skipped, 0 errors, 0 -> 0 bytes', output.getvalue())
+
+            result = decompress_job(ulz_files[1], create_ulz_data=True)
+            self.assertEqual(result.output_file, tmp_path.joinpath('sub', 'ulz_data', 'b.tim'))
+
+            # a ulz with the extension of its output is never overwritten
+            shutil.copy(self.test_ulz, tmp_path.joinpath('sub', 'd.tim'))
+            result = decompress_job(tmp_path.joinpath('sub', 'd.tim'))
+            self.assertIsNone(result.output_file)
+            self.assertIsNotNone(result.error)
+            self.assertEqual(tmp_path.joinpath('sub', 'd.tim').read_bytes(), self.test_ulz.read_bytes())
+            self.assertIsNone(decompress_job(tmp_path.joinpath('sub', 'd.tim'), create_ulz_data=True).error)
+
+    def test_compress_best(self):
+        data = self.test_tim.read_bytes()[:8000]
+        windows = [UlzWriter.conf[nbits] for nbits in sorted(UlzWriter.conf)]
+        for window, table in zip(windows, build_match_tables(data, windows)):
+            finder = HashChainMatchFinder(data, *window)
+            self.assertEqual(
+                [finder.longest_match(position) for position in range(len(data))],
+                [table.longest_match(position) for position in range(len(data))]
+            )
+
+        for strategy in ('greedy', 'optimal'):
+            nbits, ulz_data = compress_best(data, 2, strategy=strategy, max_workers=2)
+            candidates = {x: compress_bytes(data, 2, x, strategy=strategy) for x in UlzWriter.conf}
+            self.assertEqual(ulz_data, candidates[nbits])
+            self.assertEqual(len(ulz_data), min(len(x) for x in candidates.values()))
+            self.assertEqual(self.decompress(ulz_data), data)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = pathlib.Path(tmp_dir)
+            cache = CompressionCache(tmp_path.joinpath('cache'))
+            output_file = tmp_path.joinpath('out.ulz')
+
+            CliUlz().compress_file(self.test_tim, output_file, 2, 1, cache=cache)
+            expected = output_file.read_bytes()
+            key = cache.key(self.test_tim.read_bytes(), 2, 10)
+            self.assertEqual(cache.get(key), expected)
+            self.assertIsNone(cache.get(cache.key(self.test_tim.read_bytes(), 0, 10)))
+
+            # a hit is used as is, without compressing again
+            cache.put(key, expected[:-4] + b'TEST')
+            CliUlz().compress_file(self.test_tim, output_file, 2, 1, cache=cache)
+            self.assertEqual(output_file.read_bytes(), expected[:-4] + b'TEST')
+
+            cache.max_size = 2 * len(expected)
+            for name in ('a', 'b'):
+                cache.put(cache.key(name.encode(), 2, 10), expected)
+            self.assertIsNone(cache.get(key))
+            self.assertEqual(len(cache.entries()), 2)
+
+            # under max_size the directory is not scanned again
+            cache.max_size = 10 * len(expected)
+            with unittest.mock.patch.object(cache, 'evict', wraps=cache.evict) as evict:
+                for name in ('c', 'd', 'e'):
+                    cache.put(cache.key(name.encode(), 2, 10), expected)
+                evict.assert_not_called()
+            self.assertEqual(cache.total_size, sum(size for _, size, _ in cache.entries()))
+
+            # more processes share the same total
+            workers = [CompressionCache(tmp_path.joinpath('cache'), 3 * len(expected)) for _ in range(3)]
+            for idx in range(9):
+                workers[idx % 3].put(workers[0].key(str(idx).encode(), 2, 10), expected)
+            self.assertLessEqual(sum(size for _, size, _ in cache.entries()), 3 * len(expected))
+            self.assertEqual(workers[0].read_total(), sum(size for _, size, _ in cache.entries()))
+
+            umask = os.umask(0)
+            os.umask(umask)
+            for _, _, path in cache.entries():
+                self.assertEqual(path.stat().st_mode & 0o777, 0o666 & ~umask)
+
+    def test_periodic_run(self):
+        data = b'xyab' + b'ab' * 40 + b'c'
+        self.assertEqual(periodic_run(data, 4, 2, 66), 66)
+        self.assertEqual(periodic_run(data, 4, 2, 100), 80)
+        self.assertEqual(periodic_run(data, 4, 1, 66), 0)
+        self.assertEqual(periodic_run(data, 3, 3, 66), 0)
+
+        fill = b'\x11' * 5000 + bytes(range(200)) + b'\x22' * 3000
+        for nbits in UlzWriter.conf.keys():
+            ulz_data = compress_bytes(fill, 2, nbits, engine='reference')
+            self.assertEqual(self.decompress(ulz_data), fill)
+            self.assertLessEqual(len(ulz_data), len(compress_bytes(fill, 2, nbits)) + 8)
+
+    def test_effort(self):
+        data = self.test_ulz_data.read_bytes()
+        for nbits in (10, 12):
+            sizes = []
+            for effort in UlzWriter.efforts.keys():
+                ulz_data = compress_bytes(data, 2, nbits, effort=effort)
+                self.assertEqual(self.decompress(ulz_data), data, effort)
+                sizes.append(len(ulz_data))
+            self.assertEqual(sizes, sorted(sizes, reverse=True), nbits)
+
+        self.assertEqual(compress_bytes(data, 2, 12, effort=DEFAULT_EFFORT), compress_bytes(data, 2, 12))
+        self.assertEqual(
+            compress_best(data[:4000], 2, effort=0),
+            compress_best(data[:4000], 2, strategy='greedy', max_workers=2, effort=0)
+        )
+        with self.assertRaises(Exception):
+            UlzWriter(data, 2, 12, effort=10)
+
+        self.assertEqual(compress_bytes(data, 2, 12, effort=0), compress_bytes(data, 2, 12, strategy='fast'))
+        self.assertEqual(self.decompress(compress_bytes(data, 0, 10, effort=0)), data)
+
+    def test_effort_fast(self):
+        data = self.test_tim.read_bytes()
+        for effort, strategy in ((0, 'fast'), (DEFAULT_EFFORT, 'greedy'), (6, 'lazy')):
+            with unittest.mock.patch.object(HashChainWindow, 'parse_fast', autospec=True,
+                                            side_effect=HashChainWindow.parse_fast) as parse_fast:
+                writer = UlzWriter(data, 2, 10, effort=effort)
+                self.assertEqual(writer.sliding_window.strategy, strategy)
+                self.assertEqual(parse_fast.called, strategy == 'fast', effort)
+
+    def test_block_matches(self):
+        data = self.test_ulz_data.read_bytes()[:20000] + self.test_tim.read_bytes()
+        for strategy in HashChainWindow.strategies:
+            for search_buffer, look_ahead_buffer in (UlzWriter.conf[10], UlzWriter.conf[13]):
+                single = HashChainWindow(data, search_buffer, look_ahead_buffer, strategy=strategy)
+                blocks = HashChainWindow(data, search_buffer, look_ahead_buffer, strategy=strategy,
+                                         max_workers=2, block_size=3000)
+                if strategy != 'fast':
+                    self.assertIsInstance(blocks.match_finder, SparseMatchTable)
+                single.run()
+                blocks.run()
+                for field in ('flags', 'literals', 'jumps', 'runs'):
+                    self.assertEqual(
+                        getattr(single.opcodes, field),
+                        getattr(blocks.opcodes, field),
+                        (strategy, search_buffer, field)
+                    )
+
+    def test_max_size(self):
+        data = self.test_ulz_data.read_bytes()[:30000]
+        for ulz_type in (0, 2):
+            for effort in (0, 5, 6, 8):
+                expected = compress_bytes(data, ulz_type, 10, effort=effort)
+                ulz_writer = UlzWriter(data, ulz_type, 10, effort=effort, max_size=len(expected))
+                ulz_writer.pack_file()
+                self.assertEqual(ulz_writer.to_bytes(), expected, (ulz_type, effort))
+                with self.assertRaises(UlzTooBigException):
+                    UlzWriter(data, ulz_type, 10, effort=effort, max_size=len(expected) - 1).pack_file()
+
+        greedy = compress_bytes(data, 2, 10)
+        optimal = compress_bytes(data, 2, 10, strategy='optimal')
+        nbits, effort, ulz_data = compress_budget(data, 2, 10, len(optimal))
+        self.assertEqual((nbits, effort), (10, 8))
+        self.assertEqual(ulz_data, optimal)
+        self.assertEqual(compress_budget(data, 2, 10, len(greedy)), (10, None, greedy))
+        with self.assertRaises(UlzTooBigException):
+            compress_budget(data, 2, 10, len(data) // 4)
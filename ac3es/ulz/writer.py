@@ -13,12 +13,23 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with AC3ES Tools.  If not, see <http://www.gnu.org/licenses/>.
-from ac3es.cli import helpers
-from ac3es.ulz.lz77 import SlidingWindow
-import array
+from ac3es.exceptions import UlzTooBigException
+from ac3es.ulz.lz77 import SlidingWindow, HashChainWindow, build_match_tables
+import concurrent.futures
+import os
 import struct
 import logging
 
+# translate the opcode flags from lz77 into binary digits
+FLAG_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+
+# the effort used when none is given, same output of the first
+# hash_chain version
+DEFAULT_EFFORT = 5
+
+# the efforts tried by compress_budget when the file doesn't fit
+BUDGET_EFFORTS = (6, 8, 9)
+
 
 class UlzWriter:
     signature = b'\x55\x6c\x7a\x1a'
@@ -41,9 +52,30 @@ class UlzWriter:
         13: (8192, 10)
     }
 
-    def __init__(self, filename, ulz_type, nbits, store_only=False):
+    engines = {
+        'hash_chain': HashChainWindow,
+        'reference': SlidingWindow
+    }
+
+    # effort: strategy, max_chain, nice_length
+    efforts = {
+        0: ('fast', 1, None),
+        1: ('greedy', 4, None),
+        2: ('greedy', 8, None),
+        3: ('greedy', 16, None),
+        4: ('greedy', 32, None),
+        5: ('greedy', 128, None),
+        6: ('lazy', 128, 32),
+        7: ('lazy', 1024, None),
+        8: ('optimal', 128, None),
+        9: ('optimal', 8192, None),
+    }
+
+    def __init__(self, source, ulz_type, nbits, store_only=False, engine='hash_chain', strategy='greedy',
+                 match_table=None, effort=None, max_workers=1, max_size=None):
         """
-        For creating a valid Ulz file we need 2 parameters, the type and
+        For creating a valid Ulz file we need the data to compress, a
+        filename or a bytes-like object, and 2 parameters, the type and
         nbits.
 
         The type can be 0 or 2, the difference is only how the flags
@@ -58,21 +90,75 @@ class UlzWriter:
         Those values are extracted from the statistics of all the ulz
         files stored in the game.
 
+        The engine selects how the matches are found, hash_chain is
+        the fast one, reference looks for every possible prefix of
+        the look ahead buffer and it's kept for comparing the results.
+
+        The strategy is used only by hash_chain, fast checks a single
+        candidate for every match, greedy takes always the longest
+        match, lazy checks if the next byte gives a longer one and
+        optimal spends more time to find the smallest file.
+
+        A match_table from build_match_tables, made for the same data
+        and nbits, saves hash_chain the search of the matches.
+
+        The effort goes from 0, the fastest, to 9, the smallest files,
+        and replaces the strategy: it sets the strategy and how many
+        positions are checked for every match, the effort 6 takes
+        right away the matches 32 bytes long, without checking if the
+        next position has a longer one. Without an effort the
+        strategy is used as it is, fast is the same of the effort 0
+        and greedy of the effort 5.
+
+        With max_workers, hash_chain searches the matches of big files
+        with a pool of processes, the output doesn't change.
+
+        max_size is the biggest ulz file allowed, UlzTooBigException is
+        raised as soon as the data can't fit anymore, without going on
+        with the compression.
+
         """
 
         if nbits not in self.conf.keys():
             raise Exception('nbits not valid', nbits)
 
+        if engine not in self.engines.keys():
+            raise Exception('engine not valid', engine)
+
+        max_chain, nice_length = self.efforts[DEFAULT_EFFORT][1:]
+        if effort is not None:
+            if effort not in self.efforts.keys():
+                raise Exception('effort not valid', effort)
+            strategy, max_chain, nice_length = self.efforts[effort]
+
+        if strategy != 'greedy' and engine != 'hash_chain':
+            raise Exception('strategy not supported by the engine', strategy, engine)
+
         search_buffer, look_ahead_buffer = self.conf.get(nbits)
 
-        self.filename = filename
+        self.filename = source if isinstance(source, (str, os.PathLike)) else None
         self.nbits = nbits
 
-        self.sliding_window = SlidingWindow(
-            self.filename,
+        self.max_size = max_size
+        engine_options = {}
+        if max_size is not None:
+            # the opcodes take at least a bit for the flag and the bytes
+            # of the literal or the jump/run pair, plus the header
+            engine_options['max_bits'] = (max_size - 16 - (4 if ulz_type == 0 else 0)) * 8
+
+        if engine == 'hash_chain':
+            engine_options['strategy'] = strategy
+            engine_options['match_table'] = match_table
+            engine_options['max_chain'] = max_chain
+            engine_options['nice_length'] = nice_length
+            engine_options['max_workers'] = max_workers
+
+        self.sliding_window = self.engines.get(engine)(
+            source,
             search_buffer,
             look_ahead_buffer,
-            store_only
+            store_only,
+            **engine_options
         )
 
         self.sliding_window.run()
@@ -90,20 +176,11 @@ class UlzWriter:
         Write the uncompressed bytes, it's aligned to 32 bits
         """
 
-        self.uncompressed_set = list()
-
-        for x in self.sliding_window.compressed_data:
-            if x['type'] == 'uncompressed':
-                self.uncompressed_set.append(x['token'])
-
-        self.uncompressed_data = array.array(
-            'B',
-            self.uncompressed_set
-        ).tobytes()
+        self.uncompressed_data = bytearray(self.sliding_window.opcodes.literals)
 
         padding = len(self.uncompressed_data) % 4
         if padding:
-            self.uncompressed_data += b'\x00' * (4 - padding)
+            self.uncompressed_data.extend(b'\x00' * (4 - padding))
 
         self.offset_uncompressed = 16 + len(self.flags)
 
@@ -111,15 +188,19 @@ class UlzWriter:
         """
         Write compressed data stream, aligned to 32 bits
         """
-        for opcode in self.sliding_window.compressed_data:
-            if opcode['type'] == 'compressed':
-                self.compressed_data += self.pack_jmp_run(
-                    opcode['jmp'], opcode['run']
-                )
+        opcodes = self.sliding_window.opcodes
+        nbits = self.nbits
+
+        # same as pack_jmp_run, but in a single pass
+        tokens = [
+            (((run - 3) << nbits) | (jmp - 1)) & 0xFFFF
+            for jmp, run in zip(opcodes.jumps, opcodes.runs)
+        ]
+        self.compressed_data = bytearray(struct.pack('<{}H'.format(len(tokens)), *tokens))
 
         padding = len(self.compressed_data) % 4
         if padding:
-            self.compressed_data += b'\x00' * (4 - padding)
+            self.compressed_data.extend(b'\x00' * (4 - padding))
 
         self.offset_compressed = self.offset_uncompressed + len(self.uncompressed_data)
 
@@ -157,62 +238,193 @@ class UlzWriter:
         self.pack_compressed()
         self.gen_header()
 
+        size = len(self.header) + len(self.flags) + len(self.uncompressed_data) + len(self.compressed_data)
+        if self.max_size is not None and size > self.max_size:
+            raise UlzTooBigException('the ulz file is {} bytes'.format(size), self.max_size)
+
     def gen_flags(self):
         """
         Creates the flags from the sliding window data
         """
 
-        bit_flags = []
-        for x in self.sliding_window.compressed_data:
-            if x['type'] == 'compressed':
-                bit_flags.append(False)
-            else:
-                bit_flags.append(True)
-
         if self.ulz_type == 2:
-            for chunk in helpers.grouper(32, bit_flags, False):
-                flag_number = 0
-                for x in chunk:
-                    flag_number = (flag_number << 1) | (1 if x else 0)
-                self.flags += struct.pack('<I', flag_number)
-
+            word_bits = 32
         elif self.ulz_type == 0:
-            for chunk in helpers.grouper(31, bit_flags, False):
-
-                flag_number = 0
-                # last bit always true
-                for x in (chunk + (True,)):
-                    flag_number = (flag_number << 1) | (1 if x else 0)
-
-                self.flags += struct.pack('<I', flag_number)
+            word_bits = 31
         else:
             raise Exception('Ulz format not supported')
 
-        padding = len(self.flags) % 4
-        if padding:
-            self.flags += b'\x00' * (4 - padding)
+        # every flag becomes a binary digit, the first flag is the
+        # most significant bit of the first word
+        bit_flags = self.sliding_window.opcodes.flags.translate(FLAG_DIGITS)
+        num_words = -(-len(bit_flags) // word_bits)
+        bit_flags = bit_flags.ljust(num_words * word_bits, b'0')
+
+        if self.ulz_type == 0:
+            # last bit always true
+            bit_flags = b''.join(
+                bit_flags[idx:idx + word_bits] + b'1' for idx in range(0, len(bit_flags), word_bits)
+            )
+
+        words = struct.unpack(
+            '>{}I'.format(num_words),
+            int(bit_flags, 2).to_bytes(num_words * 4, 'big') if num_words else b''
+        )
+        self.flags = bytearray(struct.pack('<{}I'.format(num_words), *words))
 
         # The decompression algorithm for ulz0 doesn't have any
         # counters for the final size like ulz2, it relies on the flag
         # to ends the decompression, the process ends when the code
         # loads in r11 0x00000000
         if self.ulz_type == 0:
-            self.flags += b'\x00' * 4
+            self.flags.extend(b'\x00' * 4)
+
+    def to_bytes(self):
+        """
+        Returns the whole ulz file
+        """
+        return b''.join([
+            self.header,
+            self.flags,
+            self.uncompressed_data,
+            self.compressed_data
+        ])
+
+    def write(self, stream):
+        """
+        Writes the ulz file into a binary stream, one section at time
+        """
+        stream.write(self.header)
+        stream.write(self.flags)
+        stream.write(self.uncompressed_data)
+        stream.write(self.compressed_data)
 
     def save(self, dest_filename=None):
         """
         Saves the file
         """
-        out_filename = dest_filename or self.filename + '.ulz'
+        if not dest_filename and not self.filename:
+            raise Exception('Data not read from a file, a destination is needed')
+
+        out_filename = dest_filename or str(self.filename) + '.ulz'
         with open(out_filename, 'wb') as out_file:
-            out_file.write(self.header)
-            out_file.write(self.flags)
-            out_file.write(self.uncompressed_data)
-            out_file.write(self.compressed_data)
+            self.write(out_file)
 
         logging.debug('wrote to ' + out_filename)
 
 
+def compress_bytes(data, ulz_type, nbits, store_only=False, engine='hash_chain', strategy='greedy',
+                   effort=None) -> bytes:
+    """
+    Compress the data in memory and returns the ulz file as bytes
+    """
+    ulz_writer = UlzWriter(data, ulz_type, nbits, store_only, engine, strategy, effort=effort)
+    ulz_writer.pack_file()
+    return ulz_writer.to_bytes()
+
+
+def compress_table(data, ulz_type, nbits, store_only, strategy, match_table, effort=None) -> bytes:
+    """
+    Compress the data with matches already found, it's the job of the
+    processes started by compress_best
+    """
+    ulz_writer = UlzWriter(data, ulz_type, nbits, store_only, strategy=strategy, match_table=match_table,
+                           effort=effort)
+    ulz_writer.pack_file()
+    return ulz_writer.to_bytes()
+
+
+def compress_best(source, ulz_type, store_only=False, strategy='greedy', max_workers=1, effort=None):
+    """
+    Compress the data with every nbits and keeps the smallest file,
+    returns the winner as (nbits, bytes), on a tie the shortest search
+    buffer wins.
+
+    The matches for all the search buffers are found in a single pass,
+    then every nbits is parsed and packed in its own process.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            data = f.read()
+    else:
+        data = bytes(source)
+
+    preset_strategy, max_chain, nice_length = UlzWriter.efforts[DEFAULT_EFFORT if effort is None else effort]
+    candidates = sorted(UlzWriter.conf.keys())
+    if store_only or (strategy if effort is None else preset_strategy) == 'fast':
+        # fast doesn't use the match tables
+        tables = [None] * len(candidates)
+    else:
+        tables = build_match_tables(
+            data,
+            [UlzWriter.conf[nbits] for nbits in candidates],
+            max_chain,
+            nice_length=nice_length
+        )
+
+    jobs = (
+        [data] * len(candidates),
+        [ulz_type] * len(candidates),
+        candidates,
+        [store_only] * len(candidates),
+        [strategy] * len(candidates),
+        tables,
+        [effort] * len(candidates)
+    )
+
+    if max_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(min(max_workers, len(candidates))) as executor:
+            results = list(executor.map(compress_table, *jobs))
+    else:
+        results = list(map(compress_table, *jobs))
+
+    best = min(range(len(candidates)), key=lambda idx: len(results[idx]))
+    logging.debug('best nbits {} {} bytes'.format(candidates[best], len(results[best])))
+    return candidates[best], results[best]
+
+
+def compress_budget(source, ulz_type, nbits, max_size, store_only=False, strategy='greedy', effort=None,
+                    max_workers=1):
+    """
+    Compress the data into an ulz file of max_size bytes at most,
+    returns (nbits, effort, bytes) of the first attempt that fits.
+
+    It starts with nbits and the given strategy or effort, then tries
+    the stronger efforts and then the same with the bigger nbits. Each
+    attempt stops as soon as the file can't fit, when nothing fits
+    raises UlzTooBigException.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            source = f.read()
+
+    if effort is None:
+        # the effort with the same chain of the strategy alone, fast
+        # is the effort 0
+        default_preset = (strategy,) + UlzWriter.efforts[DEFAULT_EFFORT][1:]
+        start = next((x for x, preset in UlzWriter.efforts.items() if preset == default_preset), 0)
+    else:
+        start = effort
+
+    attempts = []
+    for attempt_nbits in sorted(x for x in UlzWriter.conf.keys() if x >= nbits):
+        attempts.append((attempt_nbits, effort))
+        if not store_only:
+            attempts.extend((attempt_nbits, x) for x in BUDGET_EFFORTS if x > start)
+
+    for attempt_nbits, attempt_effort in attempts:
+        try:
+            ulz_writer = UlzWriter(source, ulz_type, attempt_nbits, store_only, strategy=strategy,
+                                   effort=attempt_effort, max_workers=max_workers, max_size=max_size)
+            ulz_writer.pack_file()
+        except UlzTooBigException as err:
+            logging.debug('nbits {} effort {} does not fit: {}'.format(attempt_nbits, attempt_effort, err))
+            continue
+        return attempt_nbits, attempt_effort, ulz_writer.to_bytes()
+
+    raise UlzTooBigException('the data does not fit in {} bytes'.format(max_size), max_size)
+
+
 if __name__ == "__main__":
     import sys
     import logging.config